@@ -0,0 +1,557 @@
+"""Нагрузочный тест бота на локальном фейковом Bot API
+
+Поднимает в процессе HTTP-сервер, имитирующий Telegram Bot API (с настраиваемой
+задержкой и ответами 429), и прогоняет через настоящий SubscriptionBot воронку
+тысяч пользователей:
+
+    /start -> pay_subscription -> скриншот -> confirm_/reject_ админа -> /my_subscription
+
+Апдейты отдаются боту через getUpdates фейкового API, как при обычном polling,
+и проходят очередь апдейтов и PerUserUpdateProcessor. В конце печатает
+пропускную способность, p50/p99 задержки по шагам (от выдачи апдейта до конца
+обработки), число ошибок обработчиков и нарушений порядка апдейтов одного
+пользователя и время, проведенное в SQLite.
+
+Пример:
+    python benchmark.py --users 2000 --concurrency 200 --latency 30 --rate-429 0.01
+"""
+import argparse
+import asyncio
+import email
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import struct
+import tempfile
+import time
+import zlib
+from collections import Counter, defaultdict
+from urllib.parse import parse_qs
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+logger = logging.getLogger('benchmark')
+
+BOT_TOKEN = '123456:BENCHMARK'
+BOT_ID = 123456
+ADMIN_ID = 1
+CHANNEL_ID = -1001000000000
+FIRST_USER_ID = 100000
+
+
+def screenshot_png(seed, width=720, height=1280, columns=9, rows=8):
+    """PNG-"скриншот" из серых прямоугольников случайной яркости
+
+    Сетка совпадает с уменьшенной копией dHash, поэтому у разных seed
+    заведомо разные перцептивные хэши, а у одного seed - одинаковые.
+    """
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(rows):
+        shades = [rng.randrange(256) for _ in range(columns)]
+        line = b'\0' + b''.join(bytes([shade]) * (width // columns) for shade in shades)
+        lines.extend([line] * (height // rows))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    header = struct.pack('>IIBBBBB', width // columns * columns, height // rows * rows, 8, 0, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(b''.join(lines))) + chunk(b'IEND', b''))
+
+
+class FakeBotApi:
+    """Фейковый Telegram Bot API поверх asyncio
+
+    latency - задержка каждого ответа в секундах,
+    rate_429 - доля запросов, на которые отвечаем "Too Many Requests".
+    """
+
+    def __init__(self, latency=0.0, rate_429=0.0, retry_after=1):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.errors_429 = Counter()
+        self.updates = asyncio.Queue()
+        self.webhook_url = ''
+        self.documents = []
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._server = None
+        self.port = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self, port=0):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def push_update(self, update):
+        """Кладет апдейт в очередь для getUpdates и возвращает его update_id"""
+        update.setdefault('update_id', next(self._update_ids))
+        self.updates.put_nowait(update)
+        return update['update_id']
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode().split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+
+                if headers.get('transfer-encoding') == 'chunked':
+                    body = b''
+                    while True:
+                        size = int((await reader.readline()).strip(), 16)
+                        chunk = await reader.readexactly(size + 2)
+                        if size == 0:
+                            break
+                        body += chunk[:-2]
+                else:
+                    body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                if target.startswith('/file/'):
+                    # Скачивание файла: /file/bot<token>/<file_path>
+                    status, content_type, data = 200, 'image/png', await self._download(target)
+                else:
+                    method = target.split('?')[0].rsplit('/', 1)[-1]
+                    status, payload = await self._dispatch(method, self._parse(headers, body))
+                    content_type, data = 'application/json', json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Незавершенный long polling getUpdates при остановке
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse(headers, body):
+        """Разбирает параметры запроса (json, urlencoded или multipart)"""
+        content_type = headers.get('content-type', '')
+        params = {}
+        if content_type.startswith('multipart/form-data'):
+            message = email.message_from_bytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + body
+            )
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                if part.get_filename():
+                    params[name] = part.get_payload(decode=True)
+                else:
+                    params[name] = part.get_payload(decode=True).decode()
+        elif content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        else:
+            params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+        for key, value in params.items():
+            if isinstance(value, str):
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    pass
+        return params
+
+    def _chat(self, chat_id):
+        chat_id = int(chat_id) if str(chat_id).lstrip('-').isdigit() else chat_id
+        if isinstance(chat_id, int) and chat_id > 0:
+            return {'id': chat_id, 'type': 'private', 'first_name': f'User{chat_id}'}
+        return {'id': chat_id, 'type': 'channel', 'title': 'Channel'}
+
+    def _message(self, chat_id, **fields):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': self._chat(chat_id),
+        }
+        message.update(fields)
+        return message
+
+    def _photo(self):
+        n = next(self._file_ids)
+        return [{'file_id': f'photo-{n}', 'file_unique_id': f'uphoto-{n}', 'width': 848, 'height': 1280}]
+
+    async def _dispatch(self, method, params):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method != 'getUpdates' and self.rate_429 and random.random() < self.rate_429:
+            self.errors_429[method] += 1
+            return 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }
+
+        handler = getattr(self, f'api_{method}', None)
+        if handler is None:
+            return 400, {'ok': False, 'error_code': 400, 'description': f'Bad Request: unknown method {method}'}
+        return 200, {'ok': True, 'result': await handler(params)}
+
+    async def api_getMe(self, params):
+        return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot',
+                'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+
+    async def api_getUpdates(self, params):
+        timeout = float(params.get('timeout') or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout) if timeout else self.updates.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        while not self.updates.empty() and len(updates) < int(params.get('limit') or 100):
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def _download(self, target):
+        self.calls['download'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        file_id = target.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+        return screenshot_png(file_id)
+
+    async def api_getFile(self, params):
+        file_id = params['file_id']
+        return {'file_id': file_id, 'file_unique_id': f'u-{file_id}', 'file_path': f'photos/{file_id}.png'}
+
+    async def api_setWebhook(self, params):
+        self.webhook_url = params.get('url', '')
+        return True
+
+    async def api_deleteWebhook(self, params):
+        self.webhook_url = ''
+        return True
+
+    async def api_sendMessage(self, params):
+        return self._message(params['chat_id'], text=str(params.get('text', '')))
+
+    async def api_sendPhoto(self, params):
+        return self._message(params['chat_id'], photo=self._photo(), caption=str(params.get('caption', '')))
+
+    async def api_sendMediaGroup(self, params):
+        return [self._message(params['chat_id'], photo=self._photo(), caption=str(item.get('caption', '')))
+                for item in params.get('media', [])]
+
+    async def api_sendDocument(self, params):
+        self.documents.append(params.get('document'))
+        n = next(self._file_ids)
+        return self._message(params['chat_id'], document={'file_id': f'document-{n}', 'file_unique_id': f'udocument-{n}'})
+
+    async def api_editMessageText(self, params):
+        return self._message(params.get('chat_id', ADMIN_ID), text=str(params.get('text', '')))
+
+    async def api_editMessageCaption(self, params):
+        return self._message(params.get('chat_id', ADMIN_ID), photo=self._photo(),
+                             caption=str(params.get('caption', '')))
+
+    async def api_answerCallbackQuery(self, params):
+        return True
+
+    async def api_restrictChatMember(self, params):
+        return True
+
+    async def api_banChatMember(self, params):
+        return True
+
+    async def api_unbanChatMember(self, params):
+        return True
+
+    async def api_getChat(self, params):
+        return self._chat(params['chat_id'])
+
+
+class Funnel:
+    """Генератор апдейтов воронки для одного прогона"""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}',
+                'username': f'user_{user_id}', 'language_code': 'ru'}
+
+    def _message(self, user_id, **fields):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': f'User{user_id}'},
+            'from': self._user(user_id),
+        }
+        message.update(fields)
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def command(self, user_id, command):
+        return self._message(user_id, text=command,
+                             entities=[{'type': 'bot_command', 'offset': 0, 'length': len(command)}])
+
+    def photo(self, user_id):
+        return self._message(user_id, photo=[
+            {'file_id': f'screenshot-{user_id}', 'file_unique_id': f'u-screenshot-{user_id}',
+             'width': 720, 'height': 1280}
+        ])
+
+    def callback(self, user_id, data, chat_id=None):
+        chat_id = chat_id or user_id
+        return {
+            'update_id': next(self._update_ids),
+            'callback_query': {
+                'id': str(next(self._update_ids)),
+                'from': self._user(user_id),
+                'chat_instance': str(chat_id),
+                'data': data,
+                'message': {
+                    'message_id': next(self._message_ids),
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'photo': [{'file_id': 'admin-photo', 'file_unique_id': 'u-admin-photo',
+                               'width': 720, 'height': 1280}],
+                    'caption': 'payment',
+                },
+            },
+        }
+
+
+    def chat_member(self, user_id, old_status, new_status, chat_id=CHANNEL_ID):
+        now = int(time.time())
+
+        def member(status):
+            return {'status': status, 'user': self._user(user_id), 'until_date': 0}
+
+        return {
+            'update_id': next(self._update_ids),
+            'chat_member': {
+                'chat': {'id': chat_id, 'type': 'channel', 'title': 'MindWomen'},
+                'from': self._user(user_id),
+                'date': now,
+                'old_chat_member': member(old_status),
+                'new_chat_member': member(new_status),
+            },
+        }
+
+
+class UpdateTracker:
+    """Подает апдейты через getUpdates и считает задержки, ошибки и порядок
+
+    Application.process_update не пробрасывает исключения обработчиков, а
+    отдает их обработчикам ошибок, поэтому ошибки считает свой обработчик
+    ошибок. Конец обработки отмечает TypeHandler в последней группе: она
+    выполняется после обработчиков бота, даже если они упали.
+    """
+
+    GROUP = 1000
+
+    def __init__(self, api, application):
+        self.api = api
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.reordered = 0
+        self._pending = {}  # update_id -> (шаг, начало, future)
+        self._last = {}  # user_id -> update_id последнего обработанного апдейта
+        application.add_handler(TypeHandler(Update, self._done), group=self.GROUP)
+        application.add_error_handler(self._error)
+
+    def submit(self, name, data, started=None):
+        """Выдает апдейт боту, future завершится после его обработки"""
+        future = asyncio.get_running_loop().create_future()
+        update_id = self.api.push_update(data)
+        self._pending[update_id] = (name, started or time.perf_counter(), future)
+        return future
+
+    async def _error(self, update, context):
+        item = self._pending.get(getattr(update, 'update_id', None))
+        if item:
+            self.errors[item[0]] += 1
+
+    async def _done(self, update, context):
+        item = self._pending.pop(update.update_id, None)
+        if item is None:
+            return
+        name, started, future = item
+        self.latencies[name].append(time.perf_counter() - started)
+        # Апдейты одного пользователя должны обрабатываться в порядке поступления
+        user = update.effective_user
+        if user:
+            if self._last.get(user.id, 0) > update.update_id:
+                self.reordered += 1
+            self._last[user.id] = max(self._last.get(user.id, 0), update.update_id)
+        future.set_result(None)
+
+
+async def drain_outbox(bot, poll_interval=0.05):
+    """Ждет доставки всех действий outbox, возвращает время ожидания в секундах
+
+    Подтверждение и отклонение платежа только пишут действия в outbox, без
+    ожидания доставки прогон закончился бы раньше их вызовов Bot API.
+    """
+    started = time.perf_counter()
+    while (await bot.db.fetchone("SELECT count(*) FROM outbox WHERE status = 'pending'"))[0]:
+        await asyncio.sleep(poll_interval)
+    return time.perf_counter() - started
+
+
+async def start_polling(application):
+    await application.start()
+    await application.updater.start_polling(poll_interval=0, allowed_updates=Update.ALL_TYPES)
+
+
+async def stop_polling(application):
+    await application.updater.stop()
+    await application.stop()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def setup_environment(api, unthrottled, channel_id=CHANNEL_ID, prefix='mindwomen-bench-'):
+    """Окружение бота на фейковом API во временном каталоге, возвращает модуль bot"""
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': BOT_TOKEN,
+        'CHANNEL_ID': str(channel_id),
+        'ADMIN_CHAT_ID': str(ADMIN_ID),
+        'CARD_NUMBER': '0000 0000 0000 0000',
+        'CARD_HOLDER': 'BENCHMARK',
+        'DATABASE_PATH': os.path.join(workdir, 'subscriptions.db'),
+        'TELEGRAM_API_URL': api.url,
+    })
+    os.environ.pop('RECORD_UPDATES', None)
+    if unthrottled:
+        os.environ.update({'SEND_RATE': '100000', 'SEND_CHAT_RATE': '100000', 'SEND_CONCURRENCY': '256'})
+
+    # Импортируем бота только после настройки окружения
+    import bot as bot_module
+    logging.getLogger('bot').setLevel(logging.WARNING)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    return bot_module
+
+
+def print_report(steps, tracker, db_timings, db_before, api):
+    """Задержки по шагам, время в SQLite и вызовы Bot API"""
+    print(f"{'шаг':<18}{'кол-во':>8}{'ошибки':>8}{'p50, мс':>10}{'p99, мс':>10}{'сред., мс':>11}")
+    for name in steps:
+        values = tracker.latencies.get(name)
+        if not values:
+            continue
+        print(f"{name:<18}{len(values):>8}{tracker.errors[name]:>8}"
+              f"{percentile(values, 0.5) * 1000:>10.1f}{percentile(values, 0.99) * 1000:>10.1f}"
+              f"{statistics.mean(values) * 1000:>11.1f}")
+    print(f"\nНарушений порядка апдейтов пользователя: {tracker.reordered}")
+
+    print("\nSQLite:")
+    for kind, (count, seconds) in db_timings.items():
+        count -= db_before[kind][0]
+        seconds -= db_before[kind][1]
+        avg = seconds / count * 1000 if count else 0
+        print(f"  {kind:<6} операций: {count:>7}, всего {seconds:.2f} с, в среднем {avg:.2f} мс")
+
+    print("\nВызовы Bot API:")
+    for method, count in sorted(api.calls.items()):
+        print(f"  {method:<22}{count:>8}  (429: {api.errors_429[method]})")
+
+
+async def run_benchmark(args):
+    api = FakeBotApi(latency=args.latency / 1000, rate_429=args.rate_429)
+    await api.start()
+    bot_module = setup_environment(api, args.unthrottled)
+
+    bot = bot_module.SubscriptionBot(BOT_TOKEN)
+    application = bot.application
+    tracker = UpdateTracker(api, application)
+    funnel = Funnel()
+
+    async def step(name, data):
+        await tracker.submit(name, data)
+
+    async def simulate(user_id, semaphore):
+        async with semaphore:
+            await step('start', funnel.command(user_id, '/start'))
+            await step('pay_subscription', funnel.callback(user_id, 'pay_subscription'))
+            await step('screenshot', funnel.photo(user_id))
+
+            row = await bot.db.fetchone(
+                'SELECT id FROM pending_payments WHERE user_id = ? ORDER BY id DESC LIMIT 1', (user_id,)
+            )
+            if row:
+                if random.random() < args.reject_ratio:
+                    await step('reject', funnel.callback(ADMIN_ID, f'reject_{row[0]}', chat_id=ADMIN_ID))
+                else:
+                    await step('confirm', funnel.callback(ADMIN_ID, f'confirm_{row[0]}', chat_id=ADMIN_ID))
+                    await step('join', funnel.chat_member(user_id, 'left', 'member'))
+
+            await step('my_subscription', funnel.command(user_id, '/my_subscription'))
+
+    async with application:
+        await bot.post_init(application)
+        await start_polling(application)
+
+        db_before = {k: list(v) for k, v in bot.db.timings.items()}
+        semaphore = asyncio.Semaphore(args.concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            simulate(FIRST_USER_ID + i, semaphore) for i in range(args.users)
+        ))
+        elapsed = time.perf_counter() - started
+        drain = await drain_outbox(bot)
+
+        await stop_polling(application)
+    await bot.post_shutdown(application)
+    await api.stop()
+
+    total = sum(len(v) for v in tracker.latencies.values())
+    print(f"\nПользователей: {args.users}, апдейтов: {total}, время: {elapsed + drain:.2f} с "
+          f"(из них доставка outbox после последнего апдейта: {drain:.2f} с), "
+          f"пропускная способность: {total / (elapsed + drain):.1f} апдейтов/с\n")
+    print_report(('start', 'pay_subscription', 'screenshot', 'confirm', 'join', 'reject', 'my_subscription'),
+                 tracker, bot.db.timings, db_before, api)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000, help='число симулируемых пользователей')
+    parser.add_argument('--concurrency', type=int, default=100, help='сколько пользователей проходят воронку одновременно')
+    parser.add_argument('--latency', type=float, default=20, help='задержка ответа Bot API, мс')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='доля ответов 429 Too Many Requests')
+    parser.add_argument('--reject-ratio', type=float, default=0.1, help='доля отклоненных платежей')
+    parser.add_argument('--unthrottled', action='store_true',
+                        help='снять лимиты SendEngine, чтобы мерить только сам бот')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    asyncio.run(run_benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
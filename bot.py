@@ -1,14 +1,48 @@
 import os
 import logging
 import asyncio
+import csv
+import gzip
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
+import json
+import math
+import queue
+import re
+import shutil
+import signal
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from functools import lru_cache
+import httpx
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, \
-    MessageHandler, filters
-from telegram.error import BadRequest, Forbidden
+    MessageHandler, ChatMemberHandler, filters, BaseUpdateProcessor
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 import sqlite3
 from dotenv import load_dotenv
 
+try:
+    from PIL import Image
+except ImportError:
+    # Без Pillow скриншоты сравниваются только по file_unique_id
+    Image = None
+
 load_dotenv()
 
 # Настройка логирования
@@ -27,6 +61,11 @@ required_vars = [
     'CARD_HOLDER'
 ]
 
+# Режим работы: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+if BOT_MODE == 'webhook':
+    required_vars.append('WEBHOOK_URL')
+
 missing_vars = [var for var in required_vars if not os.getenv(var)]
 
 if missing_vars:
@@ -43,6 +82,2118 @@ SUBSCRIPTION_PRICE = os.getenv('SUBSCRIPTION_PRICE', '1000')
 
 # Опциональные переменные
 WELCOME_IMAGE_URL = os.getenv('WELCOME_IMAGE_URL', "https://raw.githubusercontent.com/DariaBurd/mindwomen-bot/main/images/welcome.png")
+WELCOME_IMAGE_PATH = os.getenv(
+    'WELCOME_IMAGE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images', 'welcome.jpg')
+)
+# Тексты сообщений: texts/<язык>.json
+TEXTS_DIR = os.getenv('TEXTS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'texts'))
+DEFAULT_LANGUAGE = os.getenv('DEFAULT_LANGUAGE', 'ru')
+
+# Настройки webhook-режима
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+# Несколько процессов-воркеров за одним webhook (WORKER_INDEX задает роутер)
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '1'))
+WORKER_BASE_PORT = int(os.getenv('WORKER_BASE_PORT', '8600'))
+WORKER_INDEX = int(os.environ['WORKER_INDEX']) if os.getenv('WORKER_INDEX') else None
+LEASE_TTL = int(os.getenv('LEASE_TTL', '30'))
+
+# Параллельная обработка апдейтов
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '16'))
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', '256'))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '100'))
+
+# Запись входящих апдейтов для replay.py: путь к файлу JSON Lines (пусто -
+# запись выключена) и ключ обезличивания id. Без RECORD_SALT ключ случайный,
+# и id одного пользователя в записях разных запусков не совпадают
+RECORD_UPDATES = os.getenv('RECORD_UPDATES', '')
+RECORD_SALT = os.getenv('RECORD_SALT', '')
+
+# Адрес локального Bot API сервера (например, для нагрузочного теста)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+DB_PATH = os.getenv('DATABASE_PATH', 'subscriptions.db')
+DB_READERS = int(os.getenv('DB_READERS', '4'))
+EXPIRY_CHECK_INTERVAL = int(os.getenv('EXPIRY_CHECK_INTERVAL', '60'))
+EXPIRY_BATCH = int(os.getenv('EXPIRY_BATCH', '1000'))
+ROSTER_RECONCILE_INTERVAL = int(os.getenv('ROSTER_RECONCILE_INTERVAL', '3600'))
+STATS_FLUSH_INTERVAL = int(os.getenv('STATS_FLUSH_INTERVAL', '10'))
+
+# Напоминания о продлении: за сколько дней до окончания и шаг колеса таймеров
+REMINDER_OFFSETS = [int(days) for days in os.getenv('REMINDER_OFFSETS', '3,1').split(',') if days.strip()]
+REMINDER_TICK = int(os.getenv('REMINDER_TICK', '60'))
+REMINDER_WHEEL_SLOTS = int(os.getenv('REMINDER_WHEEL_SLOTS', '1440'))
+
+# Поиск повторно присланных скриншотов: порог расстояния Хэмминга для
+# перцептивного хэша и число потоков для его подсчета
+SCREENSHOT_HASH_DISTANCE = int(os.getenv('SCREENSHOT_HASH_DISTANCE', '6'))
+SCREENSHOT_HASH_WORKERS = int(os.getenv('SCREENSHOT_HASH_WORKERS', '2'))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', '50000'))
+SUBSCRIPTION_CACHE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_TTL', '3600'))
+
+# Очередь проверки платежей
+REVIEW_DIGEST_INTERVAL = int(os.getenv('REVIEW_DIGEST_INTERVAL', '30'))
+REVIEW_PAGE_SIZE = int(os.getenv('REVIEW_PAGE_SIZE', '8'))
+# Сколько последних сообщений очереди помнят показанные платежи
+REVIEW_PAGES_KEPT = 20
+
+# Повторное использование открытой заявки и уборка таблицы платежей
+PAYMENT_REUSE_HOURS = int(os.getenv('PAYMENT_REUSE_HOURS', '24'))
+PAYMENT_PENDING_DAYS = int(os.getenv('PAYMENT_PENDING_DAYS', '7'))
+PAYMENT_ARCHIVE_DAYS = int(os.getenv('PAYMENT_ARCHIVE_DAYS', '30'))
+COMPACTION_INTERVAL = int(os.getenv('COMPACTION_INTERVAL', '3600'))
+COMPACTION_BATCH = int(os.getenv('COMPACTION_BATCH', '500'))
+
+# Онлайн-снимки БД: период (0 - выключены), сколько хранить, страниц за шаг
+# копирования и пауза между шагами (с)
+BACKUP_DIR = os.getenv('BACKUP_DIR', os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'backups'))
+BACKUP_INTERVAL = int(os.getenv('BACKUP_INTERVAL', '86400'))
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+BACKUP_PAGES = int(os.getenv('BACKUP_PAGES', '256'))
+BACKUP_STEP_PAUSE = float(os.getenv('BACKUP_STEP_PAUSE', '0.01'))
+# Таблицы для выгрузки /export
+EXPORT_TABLES = ('users', 'pending_payments')
+EXPORT_FETCH = 1000
+
+# Дозаполнение данных миграциями: размер порции и пауза между порциями (с)
+MIGRATION_CHUNK = int(os.getenv('MIGRATION_CHUNK', '1000'))
+MIGRATION_CHUNK_PAUSE = float(os.getenv('MIGRATION_CHUNK_PAUSE', '0.05'))
+
+# Ограничения исходящих запросов к Telegram
+SEND_RATE = float(os.getenv('SEND_RATE', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+# Сколько сообщений подряд можно отправить в один чат без ожидания
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', '3'))
+SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', '8'))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '5'))
+
+# Доставка исходящих действий из outbox
+OUTBOX_BATCH = int(os.getenv('OUTBOX_BATCH', '100'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '5'))
+
+# Метрики: порт HTTP-сервера Prometheus (0 - выключен) и порог медленного апдейта
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+SLOW_UPDATE_MS = int(os.getenv('SLOW_UPDATE_MS', '0'))
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Приоритеты отправки: меньше - раньше
+PRIORITY_HIGH = 0     # админ и платежи
+PRIORITY_NORMAL = 1   # ответы пользователям
+PRIORITY_BULK = 2     # массовые уведомления
+
+# Ключ bucket для вызовов без ограничения по чату (действия с участниками канала)
+NO_CHAT_LIMIT = 'no-chat-limit'
+
+
+def parse_db_datetime(value):
+    """Разбирает дату из БД (строка с микросекундами или без них)"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value)
+    return datetime.fromisoformat(value)
+
+
+def db_epoch(value):
+    """Окончание подписки из БД в секундах epoch (число или строка прежнего формата)"""
+    if value is None or isinstance(value, int):
+        return value
+    return math.ceil(parse_db_datetime(value).timestamp())
+
+
+def telegram_api_urls():
+    """Адреса локального Bot API сервера для Bot(...), если он задан"""
+    if not TELEGRAM_API_URL:
+        return {}
+    return {
+        'base_url': f"{TELEGRAM_API_URL.rstrip('/')}/bot",
+        'base_file_url': f"{TELEGRAM_API_URL.rstrip('/')}/file/bot",
+    }
+
+
+class Metrics:
+    """Счетчики, гистограммы и gauge-метрики в текстовом формате Prometheus"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}    # (имя, метки) -> значение
+        self._histograms = {}  # (имя, метки) -> [счетчики корзин..., сумма, количество]
+        self._gauges = {}      # имя -> функция, возвращающая значение
+        self._server = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def gauge(self, name, func):
+        self._gauges[name] = func
+
+    @staticmethod
+    def _labels(labels, **extra):
+        items = list(labels) + list(extra.items())
+        if not items:
+            return ''
+        return '{' + ','.join(f'{k}="{str(v)}"' for k, v in items) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            for bound, count in zip(self.buckets, histogram):
+                lines.append(f'{name}_bucket{self._labels(labels, le=bound)} {count}')
+            lines.append(f'{name}_bucket{self._labels(labels, le="+Inf")} {histogram[-1]}')
+            lines.append(f'{name}_sum{self._labels(labels)} {histogram[-2]}')
+            lines.append(f'{name}_count{self._labels(labels)} {histogram[-1]}')
+
+        for name, func in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logger.error(f"Ошибка вычисления метрики {name}: {e}")
+                continue
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            if request_line.split(b' ')[1:2] == [b'/metrics']:
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=METRICS_HOST, port=METRICS_PORT):
+        """Запускает HTTP-сервер с /metrics"""
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+
+class SlowUpdateSampler:
+    """Сэмплирующий профайлер медленных апдейтов
+
+    Фоновый поток раз в interval снимает стек потока цикла событий. Если
+    апдейт обрабатывался дольше порога, в лог пишутся самые частые стеки
+    за время его обработки.
+    """
+
+    def __init__(self, threshold, interval=0.005, depth=8, keep=20000):
+        self.threshold = threshold
+        self.interval = interval
+        self.depth = depth
+        self._samples = deque(maxlen=keep)
+        self._thread_id = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Вызывается из потока цикла событий"""
+        self._thread_id = threading.get_ident()
+        threading.Thread(target=self._run, name='slow-update-sampler', daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None and len(stack) < self.depth:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            self._samples.append((time.monotonic(), ' <- '.join(stack)))
+
+    def report(self, name, started, finished):
+        if finished - started < self.threshold:
+            return
+        samples = Counter(stack for ts, stack in list(self._samples) if started <= ts <= finished)
+        total = sum(samples.values()) or 1
+        top = '\n'.join(f"  {count * 100 // total}% {stack}" for stack, count in samples.most_common(5))
+        logger.warning(f"Медленный апдейт {name}: {(finished - started) * 1000:.0f} мс\n{top}")
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который считает вызовы и задержку каждого метода Bot API"""
+
+    def __init__(self, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        code = 'error'
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            return code, payload
+        finally:
+            self.metrics.observe('bot_telegram_request_seconds', time.perf_counter() - started,
+                                 method=api_method)
+            self.metrics.inc('bot_telegram_requests_total', method=api_method, code=code)
+
+
+@lru_cache(maxsize=256)
+def query_label(sql):
+    """Короткое имя запроса для метрик: операция и таблица"""
+    words = sql.split()
+    match = re.search(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', sql, re.IGNORECASE)
+    operation = words[0].lower() if words else 'sql'
+    return f"{operation}_{match.group(1)}" if match else operation
+
+
+class Database:
+    """Асинхронный доступ к SQLite
+
+    Все записи выполняются в отдельном потоке и коммитятся группами
+    (одна транзакция на пачку из очереди, каждая запись - в своем SAVEPOINT),
+    чтение идет через небольшой пул соединений в режиме WAL.
+    """
+
+    def __init__(self, path, readers=DB_READERS, batch_size=256, metrics=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.metrics = metrics
+        self._writes = queue.Queue()
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._connect())
+        self._read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        self._writer = threading.Thread(target=self._write_loop, name='db-writer', daemon=True)
+        self._writer.start()
+        # Суммарное время работы с БД: вид -> [число операций, секунды]
+        self.timings = {'read': [0, 0.0], 'write': [0, 0.0]}
+        self._timings_lock = threading.Lock()
+
+    def _record(self, kind, count, seconds):
+        with self._timings_lock:
+            self.timings[kind][0] += count
+            self.timings[kind][1] += seconds
+
+    def _observe(self, label, seconds):
+        if self.metrics:
+            self.metrics.observe('bot_db_query_seconds', seconds, query=label)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _write_loop(self):
+        """Поток записи: забирает все накопившиеся задачи и коммитит их разом"""
+        conn = self._connect()
+        conn.isolation_level = None
+        stopping = False
+        while not stopping:
+            job = self._writes.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._run_batch(conn, batch)
+        conn.close()
+
+    def _run_batch(self, conn, batch):
+        results = []
+        started = time.perf_counter()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for func, label, future, loop in batch:
+                conn.execute('SAVEPOINT job')
+                job_started = time.perf_counter()
+                try:
+                    result = func(conn)
+                    conn.execute('RELEASE job')
+                    results.append((future, loop, result, None))
+                except Exception as e:
+                    conn.execute('ROLLBACK TO job')
+                    conn.execute('RELEASE job')
+                    results.append((future, loop, None, e))
+                self._observe(label, time.perf_counter() - job_started)
+            commit_started = time.perf_counter()
+            conn.execute('COMMIT')
+            self._observe('commit', time.perf_counter() - commit_started)
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи в БД: {e}")
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            results = [(future, loop, None, e) for _, _, future, loop in batch]
+        self._record('write', len(batch), time.perf_counter() - started)
+
+        for future, loop, result, error in results:
+            try:
+                loop.call_soon_threadsafe(self._resolve, future, result, error)
+            except RuntimeError:
+                # Цикл событий уже закрыт - результат никому не нужен
+                pass
+
+    @staticmethod
+    def _resolve(future, result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    async def write(self, func, label='write'):
+        """Выполняет func(conn) в потоке записи атомарно и ждет коммита"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._writes.put((func, label, future, loop))
+        return await future
+
+    async def execute(self, sql, params=()):
+        return await self.write(lambda conn: conn.execute(sql, params), query_label(sql))
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.write(lambda conn: conn.executemany(sql, seq_of_params), query_label(sql))
+
+    def _with_reader(self, func, label):
+        conn = self._readers.get()
+        started = time.perf_counter()
+        try:
+            return func(conn)
+        finally:
+            elapsed = time.perf_counter() - started
+            self._record('read', 1, elapsed)
+            self._observe(label, elapsed)
+            self._readers.put(conn)
+
+    async def read(self, func, label='read'):
+        """Выполняет func(conn) на соединении из пула чтения"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, self._with_reader, func, label)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone(), query_label(sql))
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall(), query_label(sql))
+
+    def queue_size(self):
+        return self._writes.qsize()
+
+    def close(self):
+        """Дожидается всех записей и закрывает соединения"""
+        self._writes.put(None)
+        self._writer.join()
+        self._read_executor.shutdown(wait=True)
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+
+
+class ExpiryScheduler:
+    """Очередь окончаний подписок: min-heap по subscription_end
+
+    Актуальное время окончания каждого пользователя хранится в словаре,
+    устаревшие записи кучи просто пропускаются при извлечении.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._ends = {}
+
+    def __len__(self):
+        return len(self._ends)
+
+    def reset(self, items):
+        """Перестраивает очередь из пар (user_id, timestamp окончания)"""
+        self._ends = dict(items)
+        self._heap = [(end_ts, user_id) for user_id, end_ts in self._ends.items()]
+        heapq.heapify(self._heap)
+
+    def schedule(self, user_id, end_ts):
+        self._ends[user_id] = end_ts
+        heapq.heappush(self._heap, (end_ts, user_id))
+        # Не даем куче разрастаться из-за устаревших записей
+        if len(self._heap) > 2 * len(self._ends) + 64:
+            self.reset(self._ends.items())
+
+    def cancel(self, user_id):
+        self._ends.pop(user_id, None)
+
+    def pop_due(self, now_ts):
+        """Извлекает пользователей, чья подписка закончилась к now_ts"""
+        due = []
+        while self._heap and self._heap[0][0] <= now_ts:
+            end_ts, user_id = heapq.heappop(self._heap)
+            if self._ends.get(user_id) == end_ts:
+                del self._ends[user_id]
+                due.append(user_id)
+        return due
+
+    def requeue(self, user_ids, end_ts):
+        """Возвращает извлеченных pop_due пользователей, если их не перепланировали"""
+        for user_id in user_ids:
+            if user_id not in self._ends:
+                self.schedule(user_id, end_ts)
+
+
+class ReminderWheel:
+    """Хешированное колесо таймеров для напоминаний о продлении
+
+    Время срабатывания округляется вверх до тика, запись кладется в слот
+    (номер тика % число слотов). Каждый тик просматривается только свой
+    слот, записи следующих оборотов в нем остаются. Как и в ExpiryScheduler,
+    актуальное окончание подписки хранится в словаре, а записи от
+    продленных подписок отбрасываются при срабатывании.
+    """
+
+    def __init__(self, offsets=REMINDER_OFFSETS, tick=REMINDER_TICK, slots=REMINDER_WHEEL_SLOTS):
+        self.offsets = sorted(set(offsets), reverse=True)
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._ends = {}
+        self._cursor = int(time.time() // tick)
+
+    def __len__(self):
+        return len(self._ends)
+
+    def reset(self, items, now_ts=None):
+        """Перестраивает колесо из пар (user_id, timestamp окончания)"""
+        self._slots = [[] for _ in self._slots]
+        self._ends = {}
+        for user_id, end_ts in items:
+            self.schedule(user_id, end_ts, now_ts)
+
+    def schedule(self, user_id, end_ts, now_ts=None):
+        now_ts = time.time() if now_ts is None else now_ts
+        self._ends[user_id] = end_ts
+        if end_ts <= now_ts:
+            return
+        fire = [(end_ts - days * 86400, days) for days in self.offsets]
+        upcoming = [(fire_ts, days) for fire_ts, days in fire if fire_ts > now_ts]
+        missed = [days for fire_ts, days in fire if fire_ts <= now_ts]
+        # Пропущенные напоминания (например, за время перезапуска) не копим:
+        # отправляется одно, ближайшее к окончанию
+        if missed:
+            upcoming.append((now_ts, min(missed)))
+        for fire_ts, days in upcoming:
+            # Первый тик не раньше времени срабатывания
+            tick_no = max(math.ceil(fire_ts / self.tick), self._cursor + 1)
+            self._slots[tick_no % len(self._slots)].append((tick_no, user_id, end_ts, days))
+
+    def cancel(self, user_id):
+        self._ends.pop(user_id, None)
+
+    def advance(self, now_ts):
+        """Проходит слоты до now_ts, возвращает (user_id, end_ts, days) сработавших"""
+        now_tick = int(now_ts // self.tick)
+        steps = min(now_tick - self._cursor, len(self._slots))
+        due = []
+        for tick_no in range(now_tick - steps + 1, now_tick + 1):
+            index = tick_no % len(self._slots)
+            later = []
+            for entry in self._slots[index]:
+                entry_tick, user_id, end_ts, days = entry
+                if entry_tick > now_tick:
+                    # Запись одного из следующих оборотов колеса
+                    later.append(entry)
+                elif self._ends.get(user_id) == end_ts:
+                    due.append((user_id, end_ts, days))
+            self._slots[index] = later
+        self._cursor = max(self._cursor, now_tick)
+        return due
+
+
+class SubscriptionCache:
+    """LRU-кэш user_id -> окончание подписки (epoch, 0 - подписки нет) с TTL"""
+
+    def __init__(self, maxsize=SUBSCRIPTION_CACHE_SIZE, ttl=SUBSCRIPTION_CACHE_TTL, enabled=True):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # При нескольких процессах подписки выдает и снимает другой процесс
+        # (админский воркер, лидер), и любая запись устарела бы до TTL, поэтому
+        # кэш выключается и каждый запрос идет в БД
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # user_id -> (end_ts, expires_at)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, user_id):
+        """Возвращает epoch окончания подписки или None, если записи нет"""
+        item = self._data.get(user_id)
+        if item is None or item[1] < time.monotonic():
+            if item is not None:
+                del self._data[user_id]
+            self.misses += 1
+            return None
+        self._data.move_to_end(user_id)
+        self.hits += 1
+        return item[0]
+
+    def set(self, user_id, end_ts):
+        if not self.enabled:
+            return
+        self._data[user_id] = (end_ts, time.monotonic() + self.ttl)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+class UpdateRecorder:
+    """Пишет входящие апдейты в JSON Lines с временем поступления
+
+    Id пользователей и чатов заменяются на HMAC от id, чат админа получает
+    id 1, имена, подписи и текст сообщений (кроме команды) не сохраняются.
+    file_id заменяются хэшем, чтобы повторы скриншотов остались повторами.
+    Каждое открытие файла начинается со строки-заголовка с обезличенным
+    id канала - по ней replay.py настраивает бота.
+    """
+
+    DROP = frozenset(('last_name', 'caption', 'caption_entities', 'contact', 'location',
+                      'venue', 'invite_link', 'bio', 'phone_number'))
+
+    def __init__(self, path, channel_id, admin_chat_id, salt=RECORD_SALT):
+        self.admin_chat_id = int(admin_chat_id)
+        self.salt = salt.encode() if salt else os.urandom(16)
+        # Канал, заданный через @username, в апдейтах приходит с числовым id,
+        # которого мы не знаем: replay.py тогда оставит свой CHANNEL_ID
+        numeric = str(channel_id).lstrip('-').isdigit()
+        self._file = open(path, 'a', encoding='utf-8', buffering=1)
+        self._file.write(json.dumps({'header': {
+            'channel_id': self._id(int(channel_id)) if numeric else None,
+            'admin_chat_id': 1,
+            'started': time.time(),
+        }}) + '\n')
+
+    def _digest(self, value):
+        return hmac.new(self.salt, str(value).encode(), hashlib.sha256).digest()
+
+    def _id(self, value):
+        if value == self.admin_chat_id:
+            return 1
+        anonymous = 10 ** 9 + int.from_bytes(self._digest(value)[:8], 'big') % 10 ** 12
+        # Отрицательные id каналов и супергрупп сохраняют префикс -100
+        return anonymous if value > 0 else int(f'-100{anonymous}')
+
+    def anonymize(self, value):
+        if isinstance(value, list):
+            return [self.anonymize(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        result = {}
+        for key, item in value.items():
+            if key in self.DROP:
+                continue
+            if key in ('file_id', 'file_unique_id'):
+                item = self._digest(item).hex()[:32]
+            elif key == 'text' and isinstance(item, str):
+                item = item.split()[0] if item.startswith('/') else '…'
+            elif key == 'entities':
+                item = [entity for entity in item if entity.get('type') == 'bot_command' and entity.get('offset') == 0]
+            else:
+                item = self.anonymize(item)
+            result[key] = item
+        # Пользователь или чат
+        if isinstance(value.get('id'), int) and ('is_bot' in value or 'type' in value):
+            result['id'] = self._id(value['id'])
+            for name in ('first_name', 'title'):
+                if name in result:
+                    result[name] = f"User{result['id']}" if name == 'first_name' else 'Chat'
+            if 'username' in result:
+                result['username'] = f"user_{abs(result['id'])}"
+        return result
+
+    def record(self, update):
+        """Ошибка записи не должна мешать обработке апдейта"""
+        if not isinstance(update, Update):
+            return
+        try:
+            self._file.write(json.dumps(
+                {'ts': time.time(), 'update': self.anonymize(update.to_dict())},
+                ensure_ascii=False, default=lambda value: int(value.timestamp())
+            ) + '\n')
+        except Exception as e:
+            logger.warning(f"Не удалось записать апдейт {update.update_id}: {e}")
+
+    def close(self):
+        self._file.close()
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов с сохранением порядка для каждого пользователя
+
+    Апдейты разных пользователей обрабатываются одновременно (не больше
+    max_concurrent_updates), апдейты одного пользователя - строго по очереди.
+    """
+
+    def __init__(self, max_concurrent_updates, max_pending=UPDATE_MAX_PENDING):
+        super().__init__(max_concurrent_updates)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.recorder = None
+        self._locks = {}  # user_id -> [Lock, число ожидающих апдейтов]
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+
+    @staticmethod
+    def _user_key(update):
+        if isinstance(update, Update) and update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def process_update(self, update, coroutine):
+        # Встаем в очередь пользователя до семафора: задачи запускаются в порядке
+        # поступления апдейтов, поэтому порядок внутри пользователя сохраняется,
+        # а ожидающие апдейты не занимают слоты обработки
+        if self.recorder:
+            self.recorder.record(update)
+        self.pending += 1
+        if self.pending >= self.max_pending:
+            self._capacity.clear()
+
+        key = self._user_key(update)
+        entry = None
+        if key is not None:
+            entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+        try:
+            if entry is None:
+                await super().process_update(update, coroutine)
+            else:
+                async with entry[0]:
+                    await super().process_update(update, coroutine)
+        finally:
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+            self.pending -= 1
+            if self.pending < self.max_pending:
+                self._capacity.set()
+
+    async def wait_for_capacity(self):
+        """Ждет, пока число апдейтов в обработке опустится ниже max_pending"""
+        await self._capacity.wait()
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class UpdateQueue(asyncio.Queue):
+    """Очередь апдейтов с обратным давлением
+
+    Application не забирает новый апдейт, пока обработчик перегружен, очередь
+    заполняется, и webhook-сервер перестает сразу отвечать Telegram.
+    """
+
+    def __init__(self, processor, maxsize=UPDATE_QUEUE_SIZE):
+        super().__init__(maxsize=maxsize)
+        self.processor = processor
+
+    async def get(self):
+        await self.processor.wait_for_capacity()
+        return await super().get()
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = max(capacity or rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Забирает токен (в долг, если их нет) и возвращает, сколько ждать"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def is_idle(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class SendEngine:
+    """Единая очередь исходящих запросов к Telegram
+
+    Общий token bucket на весь бот и по одному на каждый чат, ограниченное
+    число одновременных запросов, приоритеты и повтор при RetryAfter и
+    сетевых ошибках.
+    """
+
+    def __init__(self, rate=SEND_RATE, chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST,
+                 concurrency=SEND_CONCURRENCY, max_retries=SEND_MAX_RETRIES, metrics=None):
+        self.metrics = metrics
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._global = TokenBucket(rate)
+        self._chats = {}
+        self._paused_until = 0
+        self._counter = itertools.count()
+        self._queue = None
+        self._workers = []
+
+    def start(self):
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, method, *args, bucket=None, priority=PRIORITY_NORMAL, **kwargs):
+        """Ставит вызов method(*args, **kwargs) в очередь и возвращает future
+
+        bucket - ключ ограничения по чату, по умолчанию берется chat_id вызова,
+        NO_CHAT_LIMIT - только общий лимит бота.
+        """
+        if bucket is None:
+            bucket = kwargs.get('chat_id')
+        elif bucket == NO_CHAT_LIMIT:
+            bucket = None
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._counter), method, args, kwargs, bucket, future))
+        return future
+
+    async def call(self, method, *args, bucket=None, priority=PRIORITY_NORMAL, **kwargs):
+        """Выполняет вызов через очередь и возвращает его результат"""
+        return await self.submit(method, *args, bucket=bucket, priority=priority, **kwargs)
+
+    def queue_size(self):
+        return self._queue.qsize() if self._queue else 0
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, _, method, args, kwargs, bucket, future = await self._queue.get()
+            try:
+                if future.cancelled():
+                    continue
+                # Чат еще не готов принять сообщение: откладываем вызов, не занимая
+                # обработчик, чтобы один занятый чат не задерживал остальные
+                delay = self._reserve_chat(bucket)
+                if delay > 0:
+                    loop.call_later(delay, self._queue.put_nowait,
+                                    (priority, next(self._counter), method, args, kwargs, None, future))
+                    continue
+                result = await self._deliver(method, args, kwargs)
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    def _reserve_chat(self, key):
+        if key is None:
+            return 0
+        bucket = self._chats.get(key)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {k: v for k, v in self._chats.items() if not v.is_idle()}
+            bucket = self._chats[key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket.reserve()
+
+    async def _acquire(self):
+        delay = max(self._paused_until - time.monotonic(), self._global.reserve())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _deliver(self, method, args, kwargs):
+        for attempt in range(self.max_retries + 1):
+            await self._acquire()
+            try:
+                return await method(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                # Flood control действует на весь бот - притормаживаем все запросы
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(f"Flood control: пауза {retry_after} с")
+                if self.metrics:
+                    self.metrics.inc('bot_telegram_retry_after_total')
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            except BadRequest:
+                raise
+            except NetworkError as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(2 ** attempt, 30)
+                logger.warning(f"Сетевая ошибка ({e}), повтор через {delay} с")
+                await asyncio.sleep(delay)
+
+
+class MediaCache:
+    """Кэш file_id для локальных медиафайлов бота
+
+    Файл загружается в Telegram один раз, полученный file_id хранится в
+    SQLite по sha256 содержимого. Изменение файла дает новый хэш и новую
+    загрузку, а отвергнутый Telegram file_id удаляется и файл грузится заново.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._digests = {}   # path -> (mtime, size, sha256)
+        self._file_ids = {}  # sha256 -> file_id
+        self._uploads = {}   # sha256 -> Lock, чтобы файл грузился один раз
+
+    def _digest(self, path):
+        stat = os.stat(path)
+        cached = self._digests.get(path)
+        if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self._digests[path] = (stat.st_mtime, stat.st_size, digest)
+        return digest
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    async def get_file_id(self, digest):
+        file_id = self._file_ids.get(digest)
+        if file_id is None:
+            row = await self.db.fetchone('SELECT file_id FROM media_cache WHERE sha256 = ?', (digest,))
+            if row:
+                file_id = self._file_ids[digest] = row[0]
+        return file_id
+
+    async def store(self, path, digest, file_id):
+        def write(conn):
+            conn.execute('DELETE FROM media_cache WHERE path = ? AND sha256 != ?', (path, digest))
+            conn.execute('''
+                INSERT OR REPLACE INTO media_cache (sha256, path, file_id)
+                VALUES (?, ?, ?)
+            ''', (digest, path, file_id))
+
+        await self.db.write(write)
+        self._file_ids[digest] = file_id
+
+    async def invalidate(self, digest, file_id):
+        if self._file_ids.get(digest) == file_id:
+            del self._file_ids[digest]
+        await self.db.execute('DELETE FROM media_cache WHERE sha256 = ? AND file_id = ?', (digest, file_id))
+
+    async def send(self, sender, method, path, kind='photo', **kwargs):
+        """Отправляет локальный файл через sender, по возможности по file_id
+
+        method - метод отправки (send_photo, reply_photo, send_document, ...),
+        kind - имя параметра с файлом и поля сообщения с результатом.
+        """
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, self._digest, path)
+
+        file_id = await self.get_file_id(digest)
+        if file_id:
+            try:
+                return await sender.call(method, **{kind: file_id}, **kwargs)
+            except BadRequest as e:
+                logger.warning(f"Telegram отверг сохраненный file_id для {path}: {e}")
+                await self.invalidate(digest, file_id)
+
+        # Загружает один запрос, остальные дожидаются готового file_id
+        async with self._uploads.setdefault(digest, asyncio.Lock()):
+            file_id = await self.get_file_id(digest)
+            if file_id is None:
+                data = await loop.run_in_executor(None, self._read, path)
+                message = await sender.call(method, **{kind: data}, **kwargs)
+                media = getattr(message, kind)
+                if kind == 'photo':
+                    media = media[-1]
+                await self.store(path, digest, media.file_id)
+                logger.info(f"✅ Файл {path} загружен в Telegram, file_id сохранен")
+                return message
+
+        return await sender.call(method, **{kind: file_id}, **kwargs)
+
+
+class ChannelRoster:
+    """Состав канала: user_id -> статус участника по событиям chat_member
+
+    Хранится в памяти и в таблице channel_members. Пользователь, которого
+    нет в составе, считается неизвестным: для него вызовы Telegram
+    выполняются как раньше. shared - состав ведут несколько процессов,
+    поэтому статус читается из БД.
+    """
+
+    MEMBER = frozenset(('creator', 'administrator', 'member', 'restricted'))
+
+    def __init__(self, db, shared=False):
+        self.db = db
+        self.shared = shared
+        self._status = {}
+
+    def __len__(self):
+        return len(self._status)
+
+    async def load(self):
+        rows = await self.db.fetchall('SELECT user_id, status FROM channel_members')
+        self._status = {user_id: sys.intern(status) for user_id, status in rows}
+
+    async def get(self, user_id):
+        """Статус участника или None, если он неизвестен"""
+        if self.shared:
+            row = await self.db.fetchone(
+                'SELECT status FROM channel_members WHERE user_id = ?', (user_id,)
+            )
+            return row[0] if row else None
+        return self._status.get(user_id)
+
+    async def set(self, user_id, status):
+        status = sys.intern(str(status))
+        if not self.shared and self._status.get(user_id) == status:
+            return
+        self._status[user_id] = status
+        await self.db.execute('''
+            INSERT INTO channel_members (user_id, status, updated) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET status = excluded.status, updated = excluded.updated
+        ''', (user_id, status, time.time()))
+
+
+def screenshot_hash(data):
+    """64-битный dHash изображения: сравнение соседних пикселей уменьшенной копии"""
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = list(image.convert('L').resize((9, 8)).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+class BKTree:
+    """BK-дерево по расстоянию Хэмминга между 64-битными хэшами
+
+    Поиск в радиусе r обходит только поддеревья с расстоянием до узла
+    в пределах [d - r, d + r], а не все хэши.
+    """
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value, item):
+        self._size += 1
+        if self._root is None:
+            self._root = (value, [item], {})
+            return
+        node = self._root
+        while True:
+            distance = bin(node[0] ^ value).count('1')
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value, radius):
+        """Пары (расстояние, item) для хэшей не дальше radius"""
+        found = []
+        stack = [self._root] if self._root else []
+        while stack:
+            node_value, items, children = stack.pop()
+            distance = bin(node_value ^ value).count('1')
+            if distance <= radius:
+                found.extend((distance, item) for item in items)
+            for edge, child in children.items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+        return found
+
+
+class ScreenshotIndex:
+    """Индекс всех присланных скриншотов для поиска повторов
+
+    Точное совпадение ищется по file_unique_id в таблице screenshots,
+    похожие изображения - по перцептивному хэшу в BKTree. Дерево
+    дочитывает новые строки таблицы перед каждым поиском, поэтому видит
+    скриншоты, сохраненные другими процессами. Скачивание идет через
+    асинхронный клиент бота, подсчет хэша - в отдельном пуле потоков.
+    Хэш считается после ответа пользователю, строка скриншота тогда
+    перезаписывается с новым id, чтобы ее дочитали деревья всех процессов.
+    """
+
+    def __init__(self, db, distance=SCREENSHOT_HASH_DISTANCE, workers=SCREENSHOT_HASH_WORKERS):
+        self.db = db
+        self.distance = distance
+        self.tree = BKTree()
+        self._last_id = 0
+        self._lock = asyncio.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='screenshot-hash')
+
+    async def refresh(self):
+        async with self._lock:
+            rows = await self.db.fetchall('''
+                SELECT id, payment_id, phash FROM screenshots
+                WHERE id > ? AND phash IS NOT NULL ORDER BY id
+            ''', (self._last_id,))
+            for row_id, payment_id, phash in rows:
+                self.tree.add(int(phash, 16), payment_id)
+                self._last_id = row_id
+
+    async def phash(self, photo):
+        """Перцептивный хэш фото или None, если Pillow нет или фото не скачалось"""
+        if Image is None:
+            return None
+        try:
+            file = await photo.get_file()
+            data = await file.download_as_bytearray()
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, screenshot_hash, bytes(data))
+        except Exception as e:
+            logger.warning(f"Не удалось посчитать хэш скриншота {photo.file_unique_id}: {e}")
+            return None
+
+    async def find_exact(self, file_unique_id, payment_id):
+        """id платежа, к которому уже приложен этот же файл, или None"""
+        row = await self.db.fetchone('''
+            SELECT payment_id FROM screenshots WHERE file_unique_id = ? AND payment_id != ?
+        ''', (file_unique_id, payment_id))
+        return row[0] if row else None
+
+    async def find_similar(self, phash, payment_id):
+        """id платежа с похожим скриншотом (ближайший по порядку) или None"""
+        await self.refresh()
+        matches = sorted(match for match in self.tree.search(phash, self.distance)
+                         if match[1] != payment_id)
+        return matches[0][1] if matches else None
+
+    @staticmethod
+    def add(conn, payment_id, user_id, file_unique_id, phash=None, created=None):
+        """Сохраняет скриншот (вызывается внутри транзакции записи)"""
+        conn.execute('''
+            INSERT OR IGNORE INTO screenshots (payment_id, user_id, file_unique_id, phash, created)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (payment_id, user_id, file_unique_id,
+              None if phash is None else format(phash, '016x'), created or time.time()))
+
+    @staticmethod
+    def set_hash(conn, payment_id, file_unique_id, phash):
+        """Записывает посчитанный хэш скриншота заявки (внутри транзакции записи)"""
+        row = conn.execute('''
+            SELECT user_id, created FROM screenshots WHERE file_unique_id = ? AND payment_id = ?
+        ''', (file_unique_id, payment_id)).fetchone()
+        if row:
+            conn.execute('DELETE FROM screenshots WHERE file_unique_id = ?', (file_unique_id,))
+            ScreenshotIndex.add(conn, payment_id, row[0], file_unique_id, phash, row[1])
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class TemplateRegistry:
+    """Тексты и клавиатуры из TEXTS_DIR/<язык>.json, разобранные один раз при запуске
+
+    Разметка в файлах как в Markdown: *жирный* и `код`, остальные
+    спецсимволы MarkdownV2 экранируются при разборе. Поля {name} и
+    {name:формат} экранируются при подстановке, поля из constants
+    подставляются сразу. Текст без полей хранится готовой строкой.
+    Если у языка пользователя нет файла или ключа, берется язык по умолчанию.
+    """
+
+    def __init__(self, directory=TEXTS_DIR, default=DEFAULT_LANGUAGE, constants=None):
+        self.default = default
+        self.constants = constants or {}
+        self._texts = {}
+        self._keyboards = {}
+        for name in sorted(os.listdir(directory)):
+            lang, ext = os.path.splitext(name)
+            if ext != '.json':
+                continue
+            with open(os.path.join(directory, name), encoding='utf-8') as f:
+                data = json.load(f)
+            self._texts[lang] = {
+                key: self._compile('\n'.join(source) if isinstance(source, list) else source)
+                for key, source in data.get('texts', {}).items()
+            }
+            self._keyboards[lang] = {
+                key: InlineKeyboardMarkup([
+                    [InlineKeyboardButton(button['text'].format(**self.constants),
+                                          callback_data=button['callback_data']) for button in row]
+                    for row in rows
+                ])
+                for key, rows in data.get('keyboards', {}).items()
+            }
+        if default not in self._texts:
+            raise ValueError(f"Нет текстов для языка по умолчанию {default} в {directory}")
+
+    @staticmethod
+    def _escape(value, spec, in_code):
+        return escape_markdown(format(value, spec), version=2, entity_type='code' if in_code else None)
+
+    def _compile(self, source):
+        """Строка MarkdownV2 или кортеж из строк и полей (имя, формат, внутри кода)"""
+        parts = []
+        in_code = False
+        for literal, field, spec, _ in string.Formatter().parse(source):
+            chunk = []
+            for char in literal:
+                if char == '`':
+                    in_code = not in_code
+                elif char == '\\' or (not in_code and char in '_[]()~>#+-=|{}.!'):
+                    chunk.append('\\')
+                chunk.append(char)
+            parts.append(''.join(chunk))
+            if field is None:
+                continue
+            if field in self.constants:
+                parts.append(self._escape(self.constants[field], spec, in_code))
+            else:
+                parts.append((field, spec, in_code))
+        compiled = []
+        for part in parts:
+            if isinstance(part, str) and compiled and isinstance(compiled[-1], str):
+                compiled[-1] += part
+            else:
+                compiled.append(part)
+        if all(isinstance(part, str) for part in compiled):
+            return ''.join(compiled)
+        return tuple(compiled)
+
+    def language(self, user):
+        """Язык пользователя, если для него есть тексты, иначе язык по умолчанию"""
+        code = ((user.language_code if user else None) or '').split('-')[0].lower()
+        return code if code in self._texts else self.default
+
+    def _lookup(self, table, key, lang):
+        found = table.get(lang or self.default, {}).get(key)
+        return table[self.default][key] if found is None else found
+
+    def render(self, key, lang=None, **fields):
+        template = self._lookup(self._texts, key, lang)
+        if isinstance(template, str):
+            return template
+        return ''.join(
+            part if isinstance(part, str) else self._escape(fields[part[0]], part[1], part[2])
+            for part in template
+        )
+
+    def keyboard(self, key, lang=None):
+        return self._lookup(self._keyboards, key, lang)
+
+
+class DatabaseBackup:
+    """Онлайн-снимки и CSV-выгрузка БД в пуле потоков, вне цикла событий
+
+    Снимок копируется backup API SQLite по BACKUP_PAGES страниц с паузой
+    между шагами, чтобы поток записи не ждал диск. Копирование идет внутри
+    открытой транзакции чтения: в режиме WAL записи других соединений не
+    блокируются и не перезапускают копирование. Готовый снимок сжимается
+    gzip, хранятся последние keep снимков.
+    """
+
+    def __init__(self, path, directory=BACKUP_DIR, keep=BACKUP_KEEP, pages=BACKUP_PAGES, pause=BACKUP_STEP_PAUSE):
+        self.path = path
+        self.directory = directory
+        self.keep = keep
+        self.pages = pages
+        self.pause = pause
+
+    def _source(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('BEGIN')
+        conn.execute('SELECT count(*) FROM sqlite_master').fetchone()
+        return conn
+
+    def _snapshot(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"snapshot-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db"
+        raw = os.path.join(self.directory, f'.{name}')
+        target = os.path.join(self.directory, f'{name}.gz')
+        try:
+            source = self._source()
+            copy = sqlite3.connect(raw)
+            try:
+                source.backup(copy, pages=self.pages,
+                              progress=lambda status, remaining, total: time.sleep(self.pause))
+            finally:
+                copy.close()
+                source.close()
+            with open(raw, 'rb') as f_in, gzip.open(f'{target}.part', 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.replace(f'{target}.part', target)
+        finally:
+            for leftover in (raw, f'{target}.part'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+        snapshots = sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith('snapshot-') and name.endswith('.db.gz')
+        )
+        for old in snapshots[:-self.keep]:
+            os.remove(os.path.join(self.directory, old))
+        return target
+
+    async def snapshot(self):
+        """Делает снимок и возвращает путь к сжатому файлу"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._snapshot)
+
+    def _export(self, target, tables):
+        source = self._source()
+        try:
+            with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for table in tables:
+                    cursor = source.execute(f'SELECT * FROM {table}')
+                    columns = [column[0] for column in cursor.description]
+                    end_index = columns.index('subscription_end') if 'subscription_end' in columns else None
+                    # utf-8-sig - чтобы Excel открыл кириллицу без настройки кодировки
+                    with archive.open(f'{table}.csv', 'w') as raw, \
+                            io.TextIOWrapper(raw, encoding='utf-8-sig', newline='') as f:
+                        writer = csv.writer(f)
+                        writer.writerow(columns)
+                        while True:
+                            rows = cursor.fetchmany(EXPORT_FETCH)
+                            if not rows:
+                                break
+                            if end_index is not None:
+                                rows = [self._readable_end(row, end_index) for row in rows]
+                            writer.writerows(rows)
+        finally:
+            source.close()
+
+    @staticmethod
+    def _readable_end(row, index):
+        end_ts = db_epoch(row[index])
+        if end_ts is None:
+            return row
+        return row[:index] + (datetime.fromtimestamp(end_ts).isoformat(' ', 'seconds'),) + row[index + 1:]
+
+    async def export(self, target, tables=EXPORT_TABLES):
+        """Пишет таблицы в zip с CSV-файлами, строки читаются порциями"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._export, target, tables)
+
+
+class DailyStats:
+    """Дневные счетчики воронки и выручки в таблице daily_stats
+
+    События платежей пишутся через add() в той же транзакции, что и
+    изменение статуса. Частые события без своей записи в БД (/start)
+    копятся в памяти через inc() и сбрасываются flush() одной транзакцией.
+    Отчет читает по строке на день и метрику, а не всю историю.
+    """
+
+    # Метрика -> подпись в отчете
+    LABELS = {
+        'starts': 'Запусков /start',
+        'payment_requests': 'Заявок на оплату',
+        'screenshots': 'Скриншотов',
+        'confirmations': 'Подтверждено',
+        'rejections': 'Отклонено',
+        'churn': 'Закончилось подписок',
+        'revenue': 'Выручка, ₽',
+    }
+
+    def __init__(self, db):
+        self.db = db
+        self._buffer = Counter()
+
+    @staticmethod
+    def add(conn, day=None, **counts):
+        """Прибавляет счетчики за день (вызывается внутри транзакции записи)"""
+        day = day or datetime.now().strftime('%Y-%m-%d')
+        conn.executemany('''
+            INSERT INTO daily_stats (day, metric, value) VALUES (?, ?, ?)
+            ON CONFLICT(day, metric) DO UPDATE SET value = value + excluded.value
+        ''', [(day, metric, value) for metric, value in counts.items() if value])
+
+    def inc(self, metric, value=1):
+        self._buffer[(datetime.now().strftime('%Y-%m-%d'), metric)] += value
+
+    async def flush(self):
+        buffer, self._buffer = self._buffer, Counter()
+        if not buffer:
+            return
+
+        def write(conn):
+            for (day, metric), value in buffer.items():
+                self.add(conn, day, **{metric: value})
+
+        try:
+            await self.db.write(write, 'stats_flush')
+        except Exception:
+            self._buffer.update(buffer)
+            raise
+
+    async def totals(self, days):
+        """Суммы метрик за последние days дней, включая сегодня"""
+        since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        rows = await self.db.fetchall('''
+            SELECT metric, SUM(value) FROM daily_stats WHERE day >= ? GROUP BY metric
+        ''', (since,))
+        totals = Counter(dict(rows))
+        # Еще не сброшенные счетчики
+        for (day, metric), value in self._buffer.items():
+            if day >= since:
+                totals[metric] += value
+        return totals
+
+
+class Outbox:
+    """Исходящие действия Telegram, записанные вместе с изменением состояния
+
+    Обработчик добавляет действия через add() в той же транзакции записи,
+    что и меняет статус, и сразу возвращается. Фоновый цикл доставляет
+    их пачками, повторяет неудачные с экспоненциальной задержкой и после
+    max_attempts попыток переводит в dead. Недоставленные действия
+    переживают перезапуск, повтор одного ключа dedup_key игнорируется.
+    """
+
+    def __init__(self, db, batch_size=OUTBOX_BATCH, max_attempts=OUTBOX_MAX_ATTEMPTS,
+                 poll_interval=OUTBOX_POLL_INTERVAL, claim_ttl=300, metrics=None):
+        self.db = db
+        self.metrics = metrics
+        self.claim_ttl = claim_ttl
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._handlers = {}
+        self._inflight = {}
+        self._results = []
+        self._wakeup = None
+        self._task = None
+
+    @staticmethod
+    def add(conn, key, action, **payload):
+        """Добавляет действие (вызывается внутри транзакции записи)"""
+        conn.execute('''
+            INSERT OR IGNORE INTO outbox (dedup_key, action, payload) VALUES (?, ?, ?)
+        ''', (key, action, json.dumps(payload, ensure_ascii=False)))
+
+    def register(self, action, handler):
+        """handler(**payload) - корутина, доставляющая действие"""
+        self._handlers[action] = handler
+
+    def wake(self):
+        """Будит цикл доставки после коммита новых действий"""
+        if self._wakeup:
+            self._wakeup.set()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        # Прерванные действия остаются pending и будут доставлены после перезапуска
+        for task in self._inflight.values():
+            task.cancel()
+        await asyncio.gather(*self._inflight.values(), return_exceptions=True)
+        await self._flush()
+        await self.db.executemany(
+            "UPDATE outbox SET next_attempt = 0 WHERE id = ? AND status = 'pending'",
+            [(outbox_id,) for outbox_id in self._inflight]
+        )
+        self._inflight.clear()
+
+    def pending(self):
+        return len(self._inflight)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self._flush()
+                free = self.batch_size - len(self._inflight)
+                if free > 0:
+                    for row in await self.db.write(lambda conn: self._claim(conn, free), 'outbox_claim'):
+                        self._inflight[row[0]] = asyncio.create_task(self._deliver(*row))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка цикла доставки outbox: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _claim(self, conn, limit):
+        """Забирает готовые к доставке действия
+
+        Срок следующей попытки сдвигается на claim_ttl: другие процессы их
+        не возьмут, а если этот процесс упадет, действия снова станут
+        готовыми к доставке по истечении срока.
+        """
+        now = time.time()
+        rows = conn.execute('''
+            SELECT id, action, payload, attempts FROM outbox
+            WHERE status = 'pending' AND next_attempt <= ?
+            ORDER BY id LIMIT ?
+        ''', (now, limit)).fetchall()
+        conn.executemany(
+            'UPDATE outbox SET next_attempt = ? WHERE id = ?',
+            [(now + self.claim_ttl, row[0]) for row in rows]
+        )
+        return rows
+
+    async def _deliver(self, outbox_id, action, payload, attempts):
+        attempts += 1
+        status, next_attempt, error = 'done', 0, None
+        try:
+            handler = self._handlers.get(action)
+            if handler is None:
+                raise LookupError(f"нет обработчика для действия {action}")
+            await handler(**json.loads(payload))
+        except asyncio.CancelledError:
+            raise
+        except BadRequest as e:
+            # Повтор не поможет, кроме уже примененного изменения
+            if 'not modified' not in str(e).lower():
+                status, error = 'dead', str(e)
+        except (Forbidden, LookupError) as e:
+            status, error = 'dead', str(e)
+        except Exception as e:
+            error = str(e)
+            if attempts >= self.max_attempts:
+                status = 'dead'
+            else:
+                status, next_attempt = 'pending', time.time() + min(2 ** attempts, 3600)
+
+        if status == 'dead':
+            logger.error(f"❌ Действие outbox {outbox_id} ({action}) не доставлено: {error}")
+        elif error:
+            logger.warning(f"Действие outbox {outbox_id} ({action}) будет повторено: {error}")
+        if self.metrics:
+            self.metrics.inc('bot_outbox_actions_total', action=action, status=status)
+        self._results.append((status, attempts, next_attempt, error, outbox_id))
+        self._wakeup.set()
+
+    async def _flush(self):
+        """Записывает результаты доставки одной транзакцией"""
+        results, self._results = self._results, []
+        if not results:
+            return
+        try:
+            await self.db.executemany('''
+                UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, last_error = ?
+                WHERE id = ?
+            ''', results)
+        except Exception:
+            self._results = results + self._results
+            raise
+        for result in results:
+            self._inflight.pop(result[-1], None)
+
+
+# Миграции схемы: (версия, описание, изменение схемы, дозаполнение данных)
+MIGRATIONS = []
+
+
+def migration(version, description, backfill=None, remaining=None):
+    """Регистрирует миграцию схемы
+
+    Функция получает соединение и выполняет быстрые изменения схемы в одной
+    транзакции при запуске. backfill(conn, limit) дозаполняет данные в фоне
+    порциями и возвращает число обработанных строк (0 - закончено),
+    remaining - SQL, считающий строки для дозаполнения (для плана).
+    """
+    def register(func):
+        MIGRATIONS.append((version, description, func, (backfill, remaining) if backfill else None))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return register
+
+
+def add_column(conn, table, column, definition):
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+@migration(1, 'таблицы пользователей и платежей')
+def migrate_initial(conn):
+    # Миграции написаны идемпотентно: база, созданная до появления
+    # schema_version, проходит их все без изменений
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            subscription_end DATE,
+            joined_date DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS pending_payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount INTEGER DEFAULT 1000,
+            screenshot_sent BOOLEAN DEFAULT FALSE,
+            created_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'pending'
+        )
+    ''')
+
+
+@migration(2, 'отметка об обработке истекшей подписки')
+def migrate_users_removed(conn):
+    add_column(conn, 'users', 'removed', 'INTEGER DEFAULT 0')
+
+
+@migration(3, 'очередь проверки платежей')
+def migrate_review_queue(conn):
+    # Скриншот, отправитель и отметка об отправке админу
+    add_column(conn, 'pending_payments', 'screenshot_file_id', 'TEXT')
+    add_column(conn, 'pending_payments', 'first_name', 'TEXT')
+    add_column(conn, 'pending_payments', 'username', 'TEXT')
+    add_column(conn, 'pending_payments', 'notified', 'INTEGER DEFAULT 0')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pending_review
+        ON pending_payments (status, screenshot_sent, id)
+    ''')
+
+
+@migration(4, 'кэш file_id загруженных в Telegram файлов')
+def migrate_media_cache(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS media_cache (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT,
+            file_id TEXT,
+            updated DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+@migration(5, 'outbox исходящих действий Telegram')
+def migrate_outbox(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedup_key TEXT UNIQUE,
+            action TEXT,
+            payload TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt REAL DEFAULT 0,
+            last_error TEXT,
+            created_date DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_outbox_due
+        ON outbox (status, next_attempt)
+    ''')
+
+
+@migration(6, 'индексы и архив заявок на оплату')
+def migrate_payment_compaction(conn):
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pending_notify
+        ON pending_payments (status, screenshot_sent, notified, id)
+    ''')
+    conn.execute('DROP INDEX IF EXISTS idx_pending_digest')
+    # Открытая заявка пользователя и уборка по дате
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pending_user
+        ON pending_payments (user_id, status, id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pending_created
+        ON pending_payments (status, created_date)
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS pending_payments_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            amount INTEGER,
+            screenshot_sent BOOLEAN,
+            created_date DATETIME,
+            status TEXT,
+            screenshot_file_id TEXT,
+            first_name TEXT,
+            username TEXT,
+            archived_date DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def backfill_subscription_epoch(conn, limit):
+    """Переводит строки subscription_end в целые секунды epoch"""
+    rows = conn.execute('''
+        SELECT user_id, subscription_end FROM users
+        WHERE typeof(subscription_end) = 'text' LIMIT ?
+    ''', (limit,)).fetchall()
+    updates = []
+    for user_id, value in rows:
+        try:
+            updates.append((db_epoch(value), user_id))
+        except ValueError:
+            logger.warning(f"Некорректная дата подписки у пользователя {user_id}: {value!r}")
+            updates.append((None, user_id))
+    conn.executemany('UPDATE users SET subscription_end = ? WHERE user_id = ?', updates)
+    return len(rows)
+
+
+@migration(7, 'subscription_end в секундах epoch', backfill=backfill_subscription_epoch,
+           remaining="SELECT count(*) FROM users WHERE typeof(subscription_end) = 'text'")
+def migrate_subscription_epoch(conn):
+    # Новые значения пишутся числом сразу, старые строки переводятся в фоне;
+    # до окончания дозаполнения код читает оба формата
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_active
+        ON users (removed, subscription_end)
+    ''')
+
+
+@migration(8, 'аренда лидера для фоновых задач')
+def migrate_leases(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT,
+            expires REAL
+        )
+    ''')
+
+
+@migration(9, 'состав канала')
+def migrate_channel_members(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS channel_members (
+            user_id INTEGER PRIMARY KEY,
+            status TEXT,
+            updated REAL
+        )
+    ''')
+
+
+@migration(10, 'дневная статистика')
+def migrate_daily_stats(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT,
+            metric TEXT,
+            value INTEGER DEFAULT 0,
+            PRIMARY KEY (day, metric)
+        )
+    ''')
+
+
+@migration(11, 'индекс скриншотов для поиска повторов')
+def migrate_screenshots(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS screenshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payment_id INTEGER,
+            user_id INTEGER,
+            file_unique_id TEXT UNIQUE,
+            phash TEXT,
+            created REAL
+        )
+    ''')
+    add_column(conn, 'pending_payments', 'duplicate_of', 'INTEGER')
+
+
+@migration(12, 'отметка о повторе скриншота в архиве заявок')
+def migrate_archive_duplicate_of(conn):
+    add_column(conn, 'pending_payments_archive', 'duplicate_of', 'INTEGER')
+
+
+class SchemaMigrator:
+    """Применяет MIGRATIONS по порядку и ведет таблицу schema_version
+
+    Изменения схемы выполняются при запуске, каждая миграция в своей
+    транзакции. Дозаполнение данных идет после запуска порциями через
+    поток записи Database, не блокируя обработку апдейтов.
+    """
+
+    def __init__(self, path, migrations=MIGRATIONS, chunk_size=MIGRATION_CHUNK):
+        self.path = path
+        self.migrations = migrations
+        self.chunk_size = chunk_size
+
+    def _applied(self, conn):
+        """Версия -> выполнено ли дозаполнение"""
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+        ).fetchone()
+        if not exists:
+            return {}
+        return dict(conn.execute('SELECT version, backfilled FROM schema_version'))
+
+    def plan(self):
+        """Описание невыполненных миграций, база не изменяется"""
+        conn = sqlite3.connect(self.path)
+        try:
+            applied = self._applied(conn)
+            lines = []
+            for version, description, _, backfill in self.migrations:
+                if version not in applied:
+                    lines.append(f"{version}: {description} - будет применена")
+                if backfill and not applied.get(version):
+                    try:
+                        rows = f", строк: {conn.execute(backfill[1]).fetchone()[0]}" if backfill[1] else ''
+                    except sqlite3.OperationalError:
+                        # Таблицы еще нет - ее создаст одна из миграций
+                        rows = ''
+                    lines.append(f"{version}: {description} - дозаполнение данных в фоне{rows}")
+            return lines
+        finally:
+            conn.close()
+
+    def migrate(self):
+        """Применяет невыполненные изменения схемы"""
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    backfilled INTEGER DEFAULT 0,
+                    applied_date DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            applied = self._applied(conn)
+            for version, description, func, backfill in self.migrations:
+                if version in applied:
+                    continue
+                conn.execute('BEGIN IMMEDIATE')
+                # Миграцию мог уже применить другой процесс
+                if conn.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,)).fetchone():
+                    conn.execute('COMMIT')
+                    continue
+                try:
+                    func(conn)
+                    conn.execute('''
+                        INSERT INTO schema_version (version, description, backfilled) VALUES (?, ?, ?)
+                    ''', (version, description, int(backfill is None)))
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+                logger.info(f"✅ Применена миграция {version}: {description}")
+        finally:
+            conn.close()
+
+    async def backfill(self, db):
+        """Дозаполняет данные порциями, отдавая поток записи живому трафику"""
+        applied = await db.read(self._applied, 'schema_version')
+        for version, description, _, backfill in self.migrations:
+            if backfill is None or applied.get(version, 1):
+                continue
+            fill, total = backfill[0], 0
+            while True:
+                count = await db.write(lambda conn: fill(conn, self.chunk_size), f'backfill_{version}')
+                total += count
+                if count < self.chunk_size:
+                    break
+                await asyncio.sleep(MIGRATION_CHUNK_PAUSE)
+            await db.execute('UPDATE schema_version SET backfilled = 1 WHERE version = ?', (version,))
+            logger.info(f"✅ Миграция {version}: дозаполнено строк {total}")
+
+
+class LeaderLease:
+    """Аренда лидерства в общей БД
+
+    Фоновые задачи JobQueue выполняет только процесс, держащий аренду.
+    Лидер продлевает ее каждые ttl/3 секунд; если процесс упал и перестал
+    продлевать, через ttl аренду забирает другой процесс. Сам лидер
+    считает себя лидером на треть ttl меньше срока аренды, чтобы задачи
+    двух процессов не пересекались.
+    """
+
+    def __init__(self, db, name='jobs', ttl=LEASE_TTL, holder=None):
+        self.db = db
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder or f'{socket.gethostname()}:{os.getpid()}'
+        self._valid_until = 0
+
+    @property
+    def is_leader(self):
+        return time.monotonic() < self._valid_until
+
+    async def renew(self):
+        """Продлевает свою аренду или забирает просроченную чужую"""
+        started = time.monotonic()
+        now = time.time()
+
+        def write(conn):
+            conn.execute('''
+                INSERT INTO leases (name, holder, expires) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires
+                WHERE leases.holder = excluded.holder OR leases.expires < ?
+            ''', (self.name, self.holder, now + self.ttl, now))
+            return conn.execute('SELECT holder FROM leases WHERE name = ?', (self.name,)).fetchone()[0]
+
+        was_leader = self.is_leader
+        try:
+            holder = await self.db.write(write, 'lease')
+        except Exception as e:
+            logger.error(f"❌ Не удалось продлить аренду лидера: {e}")
+            return
+        self._valid_until = started + self.ttl * 2 / 3 if holder == self.holder else 0
+        if self.is_leader and not was_leader:
+            logger.info(f"👑 Процесс {self.holder} стал лидером и выполняет фоновые задачи")
+        elif was_leader and not self.is_leader:
+            logger.warning(f"Процесс {self.holder} больше не лидер (аренда у {holder})")
+
+    async def release(self):
+        """Отдает аренду при остановке, чтобы другой процесс забрал ее сразу"""
+        if self._valid_until:
+            self._valid_until = 0
+            await self.db.execute('''
+                UPDATE leases SET expires = 0 WHERE name = ? AND holder = ?
+            ''', (self.name, self.holder))
+
+
+def update_user_id(data):
+    """user_id отправителя апдейта Telegram в виде dict (0, если его нет)"""
+    if not isinstance(data, dict):
+        return 0
+    for key, value in data.items():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('chat') or value.get('user')
+            if isinstance(sender, dict) and 'id' in sender:
+                return sender['id']
+    return 0
+
+
+async def read_http_request(reader):
+    """Читает HTTP/1.1 запрос: (метод, путь, заголовки, тело) или None при закрытии"""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, path = request_line.decode('latin-1').split(' ')[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, headers, body
+
+
+def http_response(status, body=b''):
+    return (
+        f"HTTP/1.1 {status}\r\n"
+        f"Content-Type: text/plain; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n"
+    ).encode() + body
+
+
+class ShardRouter:
+    """Принимает webhook Telegram и раскладывает апдейты по процессам-воркерам
+
+    Воркер выбирается по user_id (user_id % workers), поэтому все апдейты
+    пользователя обрабатывает один процесс и в порядке поступления.
+    Воркеры - копии bot.py с WORKER_INDEX, слушают 127.0.0.1 на портах
+    base_port + индекс и работают с общей SQLite. Упавший воркер
+    перезапускается, пока он недоступен, Telegram получает 503 и повторит.
+    """
+
+    def __init__(self, token, workers=WEBHOOK_WORKERS, base_port=WORKER_BASE_PORT):
+        self.token = token
+        self.workers = workers
+        self.base_port = base_port
+        self._processes = [None] * workers
+        self._locks = [asyncio.Lock() for _ in range(workers)]
+        self._client = None
+        self._path = '/' + WEBHOOK_PATH.lstrip('/')
+
+    def run(self):
+        # Схему обновляем до запуска воркеров, чтобы они не мигрировали наперегонки
+        SchemaMigrator(DB_PATH).migrate()
+        asyncio.run(self._main())
+
+    def _spawn(self, index):
+        env = dict(os.environ, WORKER_INDEX=str(index))
+        self._processes[index] = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)] + sys.argv[1:], env=env
+        )
+        logger.info(f"Запущен воркер {index} (pid {self._processes[index].pid})")
+
+    async def _main(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        for index in range(self.workers):
+            self._spawn(index)
+        self._client = httpx.AsyncClient(timeout=30)
+        server = await asyncio.start_server(self._handle, WEBHOOK_LISTEN, WEBHOOK_PORT)
+
+        bot = Bot(self.token, **telegram_api_urls())
+        async with bot:
+            await bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES
+            )
+        logger.info(f"Webhook принимается на порту {WEBHOOK_PORT}, воркеров: {self.workers}")
+
+        while not stop.is_set():
+            for index, process in enumerate(self._processes):
+                if process.poll() is not None:
+                    logger.error(f"❌ Воркер {index} завершился с кодом {process.returncode}, перезапуск")
+                    self._spawn(index)
+            try:
+                await asyncio.wait_for(stop.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+
+        server.close()
+        await server.wait_closed()
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.wait)
+        await self._client.aclose()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_http_request(reader)
+                if request is None:
+                    break
+                writer.write(await self._route(*request))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # Остановка сервера: соединение просто закрываем
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, headers, body):
+        if method != 'POST' or path != self._path:
+            return http_response('404 Not Found')
+        if WEBHOOK_SECRET and headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET:
+            return http_response('403 Forbidden')
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return http_response('400 Bad Request')
+        if not isinstance(data, dict):
+            return http_response('400 Bad Request')
+        shard = update_user_id(data) % self.workers
+
+        # Апдейты одного воркера пересылаются по одному - порядок сохраняется
+        try:
+            async with self._locks[shard]:
+                response = await self._client.post(
+                    f'http://127.0.0.1:{self.base_port + shard}/', content=body,
+                    headers={'Content-Type': 'application/json'}
+                )
+        except httpx.HTTPError as e:
+            logger.warning(f"Воркер {shard} недоступен: {e}")
+            return http_response('503 Service Unavailable')
+        return http_response('200 OK' if response.status_code == 200 else '503 Service Unavailable')
+
 
 class SubscriptionBot:
     def __init__(self, token):
@@ -50,46 +2201,214 @@ class SubscriptionBot:
             logger.error("❌ TELEGRAM_BOT_TOKEN не найден!")
             exit(1)
 
-        self.application = Application.builder().token(token).build()
+        # Убедимся, что CHANNEL_ID правильный (должен начинаться с -100 для супергрупп)
+        self.channel_id = self.get_correct_channel_id(CHANNEL_ID)
+        self.metrics = Metrics()
+        self.sampler = SlowUpdateSampler(SLOW_UPDATE_MS / 1000) if SLOW_UPDATE_MS else None
+        self.update_processor = PerUserUpdateProcessor(UPDATE_WORKERS)
+        if RECORD_UPDATES:
+            # Каждый воркер пишет в свой файл
+            path = RECORD_UPDATES if WORKER_INDEX is None else f'{RECORD_UPDATES}.{WORKER_INDEX}'
+            self.update_processor.recorder = UpdateRecorder(path, self.channel_id, ADMIN_CHAT_ID)
+            logger.info(f"Входящие апдейты записываются в {path}")
+        builder = (
+            Application.builder()
+            .token(token)
+            .request(InstrumentedRequest(self.metrics, connection_pool_size=256))
+            .concurrent_updates(self.update_processor)
+            .update_queue(UpdateQueue(self.update_processor))
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+        )
+        urls = telegram_api_urls()
+        if urls:
+            builder = builder.base_url(urls['base_url']).base_file_url(urls['base_file_url'])
+        self.application = builder.build()
         self.setup_handlers()
         self.setup_database()
 
     def setup_database(self):
-        """Инициализация базы данных"""
-        self.conn = sqlite3.connect('subscriptions.db', check_same_thread=False)
-        self.cursor = self.conn.cursor()
-
-        # Таблица пользователей
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                subscription_end DATE,
-                joined_date DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
+        """Инициализация базы данных: миграции схемы и фоновые компоненты"""
+        self.migrator = SchemaMigrator(DB_PATH)
+        self.migrator.migrate()
+
+        self.db = Database(DB_PATH, metrics=self.metrics)
+        self.expiry = ExpiryScheduler()
+        self.reminders = ReminderWheel()
+        self.subscriptions = SubscriptionCache(enabled=WORKER_INDEX is None)
+        self.sender = SendEngine(metrics=self.metrics)
+        self.media = MediaCache(self.db)
+        self.outbox = Outbox(self.db, metrics=self.metrics)
+        self.lease = LeaderLease(self.db)
+        self.roster = ChannelRoster(self.db, shared=WORKER_INDEX is not None)
+        self.stats = DailyStats(self.db)
+        self.screenshots = ScreenshotIndex(self.db)
+        self.texts = TemplateRegistry(constants={
+            'price': SUBSCRIPTION_PRICE, 'card_number': CARD_NUMBER, 'card_holder': CARD_HOLDER,
+        })
+        self.backup = DatabaseBackup(DB_PATH)
+
+    async def post_init(self, application: Application):
+        """Загрузка состояния и запуск фоновых задач"""
+        self.sender.start()
+        self.setup_outbox(application.bot)
+        self.outbox.start()
+        self.setup_metrics()
+        self.backfill_task = asyncio.create_task(self.migrator.backfill(self.db))
+        await self.lease.renew()
+        await self.roster.load()
+        logger.info(f"Загружен состав канала: {len(self.roster)}")
+        await self.screenshots.refresh()
+        logger.info(f"Загружено хэшей скриншотов: {len(self.screenshots.tree)}")
+
+        rows = await self.db.fetchall('''
+            SELECT user_id, subscription_end FROM users
+            WHERE removed = 0 AND subscription_end IS NOT NULL
         ''')
-        
-        # Таблица ожидающих платежей
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS pending_payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                amount INTEGER DEFAULT 1000,
-                screenshot_sent BOOLEAN DEFAULT FALSE,
-                created_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'pending'
+        ends = [(user_id, db_epoch(end)) for user_id, end in rows]
+        if WORKER_INDEX is None:
+            self.expiry.reset(ends)
+            self.reminders.reset(ends)
+            logger.info(f"Загружено подписок в очередь окончаний: {len(self.expiry)}")
+        else:
+            # Воркер обслуживает только своих пользователей, а окончания
+            # подписок лидер берет из индекса БД
+            ends = [(user_id, end_ts) for user_id, end_ts in ends
+                    if user_id % WEBHOOK_WORKERS == WORKER_INDEX]
+
+        # Активные подписчики чаще всего и заходят в /start - прогреваем кэш
+        now_ts = time.time()
+        for user_id, end_ts in ends[:self.subscriptions.maxsize]:
+            if end_ts > now_ts:
+                self.subscriptions.set(user_id, end_ts)
+
+        application.job_queue.run_repeating(
+            self.instrument_job('renew_lease', lambda context: self.lease.renew(), leader_only=False),
+            interval=LEASE_TTL / 3,
+            first=LEASE_TTL / 3,
+            name='renew_lease'
+        )
+        application.job_queue.run_repeating(
+            self.instrument_job('stats_flush', lambda context: self.stats.flush(), leader_only=False),
+            interval=STATS_FLUSH_INTERVAL,
+            first=STATS_FLUSH_INTERVAL,
+            name='stats_flush'
+        )
+        application.job_queue.run_repeating(
+            self.instrument_job('check_subscriptions', self.check_subscriptions),
+            interval=EXPIRY_CHECK_INTERVAL,
+            first=10,
+            name='check_subscriptions'
+        )
+        application.job_queue.run_repeating(
+            self.instrument_job('send_reminders', self.send_reminders),
+            interval=REMINDER_TICK,
+            first=REMINDER_TICK,
+            name='send_reminders'
+        )
+        application.job_queue.run_repeating(
+            self.instrument_job('send_review_digest', self.send_review_digest),
+            interval=REVIEW_DIGEST_INTERVAL,
+            first=REVIEW_DIGEST_INTERVAL,
+            name='send_review_digest'
+        )
+        application.job_queue.run_repeating(
+            self.instrument_job('reconcile_roster', self.reconcile_roster),
+            interval=ROSTER_RECONCILE_INTERVAL,
+            first=120,
+            name='reconcile_roster'
+        )
+        application.job_queue.run_repeating(
+            self.instrument_job('compact_payments', self.compact_payments),
+            interval=COMPACTION_INTERVAL,
+            first=60,
+            name='compact_payments'
+        )
+        if BACKUP_INTERVAL > 0:
+            application.job_queue.run_repeating(
+                self.instrument_job('backup_database', self.backup_database),
+                interval=BACKUP_INTERVAL,
+                first=300,
+                name='backup_database'
             )
-        ''')
-        self.conn.commit()
+
+    async def post_shutdown(self, application: Application):
+        """Освобождение ресурсов при остановке"""
+        await self.metrics.close()
+        if self.sampler:
+            self.sampler.stop()
+        # Прерванное дозаполнение продолжится при следующем запуске
+        self.backfill_task.cancel()
+        await asyncio.gather(self.backfill_task, return_exceptions=True)
+        await self.outbox.stop()
+        await self.sender.stop()
+        await self.lease.release()
+        try:
+            await self.stats.flush()
+        except Exception as e:
+            logger.error(f"❌ Не удалось сохранить статистику: {e}")
+        self.screenshots.close()
+        if self.update_processor.recorder:
+            self.update_processor.recorder.close()
+        self.db.close()
+
+    def setup_metrics(self):
+        """Gauge-метрики очередей и кэшей, HTTP-сервер и профайлер"""
+        self.metrics.gauge('bot_update_queue_size', lambda: self.application.update_queue.qsize())
+        self.metrics.gauge('bot_updates_in_progress', lambda: self.update_processor.pending)
+        self.metrics.gauge('bot_send_queue_size', lambda: self.sender.queue_size())
+        self.metrics.gauge('bot_db_write_queue_size', lambda: self.db.queue_size())
+        self.metrics.gauge('bot_outbox_in_progress', lambda: self.outbox.pending())
+        self.metrics.gauge('bot_subscription_cache_size', lambda: len(self.subscriptions))
+        self.metrics.gauge('bot_subscription_cache_hits', lambda: self.subscriptions.hits)
+        self.metrics.gauge('bot_subscription_cache_misses', lambda: self.subscriptions.misses)
+
+        if self.sampler:
+            self.sampler.start()
+        if METRICS_PORT:
+            self.application.create_task(self.metrics.serve(port=METRICS_PORT + (WORKER_INDEX or 0)))
+
+    def instrument(self, name, callback):
+        """Оборачивает обработчик: гистограмма задержки и профайлер медленных апдейтов"""
+        async def wrapper(update, context):
+            started = time.monotonic()
+            try:
+                return await callback(update, context)
+            finally:
+                finished = time.monotonic()
+                self.metrics.observe('bot_handler_seconds', finished - started, handler=name)
+                if self.sampler:
+                    self.sampler.report(name, started, finished)
+        return wrapper
+
+    def instrument_job(self, name, callback, leader_only=True):
+        """Оборачивает задачу JobQueue: гистограмма длительности
+
+        Задачи с leader_only выполняет только процесс, держащий аренду лидера.
+        """
+        async def wrapper(context):
+            if leader_only and not self.lease.is_leader:
+                return
+            with self.metrics.time('bot_job_seconds', job=name):
+                return await callback(context)
+        return wrapper
 
     def setup_handlers(self):
         """Настройка обработчиков"""
-        self.application.add_handler(CommandHandler("start", self.start))
-        self.application.add_handler(CommandHandler("my_subscription", self.my_subscription))
-        self.application.add_handler(CallbackQueryHandler(self.handle_callback))
-        self.application.add_handler(MessageHandler(filters.PHOTO, self.handle_screenshot))
+        self.application.add_handler(CommandHandler("start", self.instrument('start', self.start)))
+        self.application.add_handler(CommandHandler(
+            "my_subscription", self.instrument('my_subscription', self.my_subscription)
+        ))
+        self.application.add_handler(CommandHandler("queue", self.instrument('queue', self.review_queue)))
+        self.application.add_handler(CommandHandler("stats", self.instrument('stats', self.stats_command)))
+        self.application.add_handler(CommandHandler("export", self.instrument('export', self.export_command)))
+        self.application.add_handler(CallbackQueryHandler(self.instrument('handle_callback', self.handle_callback)))
+        self.application.add_handler(MessageHandler(
+            filters.PHOTO, self.instrument('handle_screenshot', self.handle_screenshot)
+        ))
+        self.application.add_handler(ChatMemberHandler(
+            self.instrument('chat_member', self.track_channel_member), ChatMemberHandler.CHAT_MEMBER
+        ))
         self.application.add_error_handler(self.error_handler)
 
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -99,29 +2418,37 @@ class SubscriptionBot:
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Приветственное сообщение"""
         user = update.effective_user
-
-        welcome_text = """
-*Добро пожаловать, моя прекрасная!*
-
-*Что нам на самом деле важно* - это не бояться быть самой собой. Быть среди женщин. Все мы - сестры и отражаясь в глазах сестры мы начинаем видеть себя очень ясно.
-
-*Закрытый Клуб Осознанной Женственности* - это твое безопасное поле, где мы вместе будем практиковать, общаться, создавая общее женское комьюнити осознанности и жизни в моменте здесь и сейчас. 
-
-*Путешествие начинается.* 🌸
-        """
+        self.stats.inc('starts')
+        lang = self.texts.language(user)
+        welcome_text = self.texts.render('welcome', lang)
 
         try:
-            await update.message.reply_photo(
-                photo=WELCOME_IMAGE_URL,
-                caption=welcome_text,
-                parse_mode='Markdown'
-            )
+            if os.path.exists(WELCOME_IMAGE_PATH):
+                await self.media.send(
+                    self.sender,
+                    update.message.reply_photo,
+                    WELCOME_IMAGE_PATH,
+                    bucket=update.effective_chat.id,
+                    caption=welcome_text,
+                    parse_mode='MarkdownV2'
+                )
+            else:
+                await self.sender.call(
+                    update.message.reply_photo,
+                    bucket=update.effective_chat.id,
+                    photo=WELCOME_IMAGE_URL,
+                    caption=welcome_text,
+                    parse_mode='MarkdownV2'
+                )
         except Exception as e:
             logger.error(f"Ошибка загрузки картинки: {e}")
-            await update.message.reply_text(welcome_text, parse_mode='Markdown')
+            await self.sender.call(
+                update.message.reply_text, welcome_text,
+                bucket=update.effective_chat.id, parse_mode='MarkdownV2'
+            )
 
         # Проверяем подписку
-        subscription_end = self.get_user_subscription(user.id)
+        subscription_end = await self.get_user_subscription(user.id)
         if not subscription_end or subscription_end <= datetime.now():
             await self.offer_payment(update, user)
         else:
@@ -129,45 +2456,24 @@ class SubscriptionBot:
 
     async def send_welcome_message(self, update: Update, user, subscription_end):
         """Сообщение для пользователей с активной подпиской"""
-        welcome_text = f"""
-🌸 *Добро пожаловать в MindWomen, Королева!* 🌸
-
-*Твоя подписка активна до:* {subscription_end.strftime('%d.%m.%Y')}
-
-*Что тебя ждет в нашем сообществе:*
-• Ежедневные медитации и практики
-• Закрытый чат с сестрами
-• Мое бережное сопровождение
-• Живые встречи
-
-*Ссылка на канал:* https://t.me/+Yx9m02RdviBmNjAy
-
-*Чтобы проверить статус подписки:* /my_subscription
-
-*Мы рады тебе!* 💖
-        """
-        await update.message.reply_text(welcome_text, parse_mode='Markdown')
+        lang = self.texts.language(user)
+        # Когда подписка скоро закончится, сразу предлагаем продление
+        reply_markup = None
+        if subscription_end - datetime.now() <= timedelta(days=max(REMINDER_OFFSETS, default=0)):
+            reply_markup = self.texts.keyboard('renew', lang)
+        await self.sender.call(
+            update.message.reply_text, self.texts.render('welcome_active', lang, end=subscription_end),
+            bucket=update.effective_chat.id, parse_mode='MarkdownV2', reply_markup=reply_markup
+        )
 
     async def offer_payment(self, update: Update, user):
         """Предложение оплатить подписку"""
-        keyboard = [[InlineKeyboardButton(f"💳 Оплатить подписку - {SUBSCRIPTION_PRICE}₽/месяц", callback_data="pay_subscription")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        text = f"""
-💰 *Приобрести подписку на MindWomen*
-
-*Тариф:* {SUBSCRIPTION_PRICE}₽ в месяц
-
-*Что включено:*
-- Доступ к закрытому каналу
-- Все практики и медитации
-- Участие в живых встречах
-- Поддержка сообщества
-
-Нажмите кнопку ниже для получения реквизитов оплаты.
-        """
-
-        await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+        lang = self.texts.language(user)
+        await self.sender.call(
+            update.message.reply_text, self.texts.render('offer_payment', lang),
+            bucket=update.effective_chat.id, parse_mode='MarkdownV2',
+            reply_markup=self.texts.keyboard('pay', lang)
+        )
 
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка нажатий кнопок"""
@@ -175,144 +2481,495 @@ class SubscriptionBot:
         await query.answer()
 
         if query.data == "pay_subscription":
-            await self.send_payment_details(query)
+            with self.metrics.time('bot_handler_seconds', handler='send_payment_details'):
+                await self.send_payment_details(query)
         elif query.data.startswith('confirm_'):
             payment_id = query.data.replace('confirm_', '')
-            await self.confirm_payment(update, context, payment_id)
+            with self.metrics.time('bot_handler_seconds', handler='confirm_payment'):
+                await self.confirm_payment(update, context, payment_id)
         elif query.data.startswith('reject_'):
             payment_id = query.data.replace('reject_', '')
-            await self.reject_payment(update, context, payment_id)
+            with self.metrics.time('bot_handler_seconds', handler='reject_payment'):
+                await self.reject_payment(update, context, payment_id)
+        elif query.data.startswith(('queue_', 'qsel_', 'qall_', 'qrej_', 'qshow_')):
+            with self.metrics.time('bot_handler_seconds', handler='review_queue'):
+                await self.handle_review_callback(update, context)
 
     async def send_payment_details(self, query):
         """Отправляет реквизиты для перевода"""
         user = query.from_user
         
-        # Сохраняем запрос на оплату
-        self.cursor.execute('''
-            INSERT INTO pending_payments (user_id, amount) 
-            VALUES (?, ?)
-        ''', (user.id, SUBSCRIPTION_PRICE))
-        self.conn.commit()
-
-        payment_text = f"""
-💳 *Оплата подписки MindWomen*
-
-*Сумма:* {SUBSCRIPTION_PRICE}₽ в месяц
-
-*Реквизиты для перевода (СБЕР):*
-▫️ *Номер карты:* `{CARD_NUMBER}`
-▫️ *Получатель:* {CARD_HOLDER}
-
-*Инструкция:*
-1. Переведите {SUBSCRIPTION_PRICE}₽ на указанную карту (в приложении своего банка)
-2. Сделайте скриншот чека или перевода
-3. Пришлите скриншот в этот чат
-
-✅ *После проверки вы будете добавлены в закрытый канал.*
-*Обычно проверка занимает до 24 часов.*
-        """
-
-        await query.message.reply_text(payment_text, parse_mode='Markdown')
+        # Сохраняем запрос на оплату, повторное нажатие использует открытую заявку
+        def write(conn):
+            if conn.execute('''
+                SELECT 1 FROM pending_payments
+                WHERE user_id = ? AND status = 'pending' AND created_date >= datetime('now', ?)
+                LIMIT 1
+            ''', (user.id, f'-{PAYMENT_REUSE_HOURS} hours')).fetchone() is None:
+                conn.execute('''
+                    INSERT INTO pending_payments (user_id, amount)
+                    VALUES (?, ?)
+                ''', (user.id, SUBSCRIPTION_PRICE))
+                DailyStats.add(conn, payment_requests=1)
+
+        await self.db.write(write, 'create_payment')
+
+        await self.sender.call(
+            query.message.reply_text, self.texts.render('payment_details', self.texts.language(user)),
+            bucket=query.message.chat_id, priority=PRIORITY_HIGH, parse_mode='MarkdownV2'
+        )
 
     async def handle_screenshot(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка скриншотов от пользователей"""
         user = update.effective_user
-        
+        lang = self.texts.language(user)
+
         if update.message.photo:
             # Находим ожидающий платеж пользователя
-            self.cursor.execute('''
-                SELECT id FROM pending_payments 
+            result = await self.db.fetchone('''
+                SELECT id FROM pending_payments
                 WHERE user_id = ? AND status = 'pending'
-                ORDER BY created_date DESC LIMIT 1
+                ORDER BY id DESC LIMIT 1
             ''', (user.id,))
             
-            result = self.cursor.fetchone()
-            
             if result:
                 payment_id = result[0]
-                
-                # Помечаем как отправленный
-                self.cursor.execute('''
-                    UPDATE pending_payments SET screenshot_sent = TRUE WHERE id = ?
-                ''', (payment_id,))
-                self.conn.commit()
-
-                await update.message.reply_text(
-                    "✅ *Скриншот получен!*\n\n"
-                    "Платеж передан на проверку. Обычно это занимает до 24 часов.\n"
-                    "Вы получите уведомление, когда будете добавлены в канал.",
-                    parse_mode='Markdown'
+                photo = update.message.photo[-1]
+
+                # Скриншот, уже приложенный к другой заявке, админу не отправляем
+                duplicate_of = await self.screenshots.find_exact(photo.file_unique_id, payment_id)
+                if duplicate_of:
+                    self.metrics.inc('bot_screenshot_duplicates_total', kind='exact')
+                    logger.info(f"Скриншот к платежу #{payment_id} совпадает с #{duplicate_of} (exact)")
+                    await self.sender.call(
+                        update.message.reply_text,
+                        self.texts.render('screenshot_duplicate', lang),
+                        bucket=update.effective_chat.id,
+                        priority=PRIORITY_HIGH,
+                        parse_mode='MarkdownV2'
+                    )
+                    return
+
+                # Помечаем как отправленный, админ получит скриншот в ближайшей сводке
+                def write(conn):
+                    first = not conn.execute(
+                        'SELECT screenshot_sent FROM pending_payments WHERE id = ?', (payment_id,)
+                    ).fetchone()[0]
+                    conn.execute('''
+                        UPDATE pending_payments
+                        SET screenshot_sent = TRUE, screenshot_file_id = ?, first_name = ?, username = ?,
+                            notified = 0, duplicate_of = NULL
+                        WHERE id = ?
+                    ''', (photo.file_id, user.first_name, user.username, payment_id))
+                    ScreenshotIndex.add(conn, payment_id, user.id, photo.file_unique_id)
+                    # Повторный скриншот к той же заявке в статистику не идет
+                    if first:
+                        DailyStats.add(conn, screenshots=1)
+
+                await self.db.write(write, 'save_screenshot')
+
+                await self.sender.call(
+                    update.message.reply_text,
+                    self.texts.render('screenshot_received', lang),
+                    bucket=update.effective_chat.id,
+                    priority=PRIORITY_HIGH,
+                    parse_mode='MarkdownV2'
                 )
-
-                # Уведомляем администратора
-                await self.notify_admin(context.bot, user, payment_id, update.message.photo[-1].file_id)
+                # Похожий скриншот ищем уже после ответа: скачивание и хэш
+                # не задерживают пользователя, пометка появится в очереди
+                if Image is not None:
+                    context.application.create_task(
+                        self.mark_similar_screenshot(photo, payment_id), update=update
+                    )
             else:
-                await update.message.reply_text(
-                    "❌ *Сначала выберите опцию оплаты*\n\n"
-                    "Нажмите /start и выберите 'Оплатить подписку'",
-                    parse_mode='Markdown'
+                await self.sender.call(
+                    update.message.reply_text,
+                    self.texts.render('screenshot_without_payment', lang),
+                    bucket=update.effective_chat.id,
+                    parse_mode='MarkdownV2'
                 )
 
-    async def notify_admin(self, bot, user, payment_id, screenshot_file_id):
-        """Уведомляет администратора о новом платеже"""
-        admin_text = f"""
-🔄 *Новый платеж на проверку*
+    async def mark_similar_screenshot(self, photo, payment_id):
+        """Считает хэш скриншота и помечает заявку, если он похож на чужой"""
+        phash = await self.screenshots.phash(photo)
+        if phash is None:
+            return
+        duplicate_of = await self.screenshots.find_similar(phash, payment_id)
+
+        def write(conn):
+            ScreenshotIndex.set_hash(conn, payment_id, photo.file_unique_id, phash)
+            if duplicate_of:
+                conn.execute('''
+                    UPDATE pending_payments SET duplicate_of = ?
+                    WHERE id = ? AND screenshot_file_id = ?
+                ''', (duplicate_of, payment_id, photo.file_id))
+
+        await self.db.write(write, 'screenshot_hash')
+        if duplicate_of:
+            self.metrics.inc('bot_screenshot_duplicates_total', kind='similar')
+            logger.info(f"Скриншот к платежу #{payment_id} совпадает с #{duplicate_of} (similar)")
+
+    def is_admin_chat(self, chat_id):
+        return str(chat_id) == str(ADMIN_CHAT_ID).strip()
+
+    @staticmethod
+    def review_caption(payment_id, user_id, first_name, username, amount, duplicate_of=None):
+        caption = f"#{payment_id} · {first_name or ''} @{username or 'нет'} (ID {user_id}) · {amount}₽"
+        if duplicate_of:
+            caption += f" · ⚠️ похож на #{duplicate_of}"
+        return caption
+
+    async def send_review_digest(self, context: ContextTypes.DEFAULT_TYPE):
+        """Отправляет админу новые скриншоты альбомами до 10 штук"""
+        sent = 0
+        while True:
+            rows = await self.db.fetchall('''
+                SELECT id, user_id, first_name, username, amount, duplicate_of, screenshot_file_id
+                FROM pending_payments
+                WHERE status = 'pending' AND notified = 0 AND screenshot_sent = 1
+                ORDER BY id LIMIT 10
+            ''')
+            if not rows:
+                break
+
+            media = [InputMediaPhoto(row[-1], caption=self.review_caption(*row[:-1])) for row in rows]
+            try:
+                if len(media) == 1:
+                    await self.sender.call(
+                        context.bot.send_photo, priority=PRIORITY_HIGH,
+                        chat_id=ADMIN_CHAT_ID, photo=media[0].media, caption=media[0].caption
+                    )
+                else:
+                    await self.sender.call(
+                        context.bot.send_media_group, priority=PRIORITY_HIGH,
+                        chat_id=ADMIN_CHAT_ID, media=media
+                    )
+            except Exception as e:
+                logger.error(f"Ошибка отправки скриншотов админу: {e}")
+                break
 
-*Пользователь:* {user.first_name} {user.last_name or ''}
-*Username:* @{user.username or 'нет'}
-*ID:* {user.id}
-*Сумма:* {SUBSCRIPTION_PRICE}₽
-*Время:* {datetime.now().strftime('%d.%m.%Y %H:%M')}
+            await self.db.executemany(
+                'UPDATE pending_payments SET notified = 1 WHERE id = ?',
+                [(row[0],) for row in rows]
+            )
+            sent += len(rows)
 
-*Для подтверждения нажмите кнопку:*
+        if sent:
+            keyboard = [[InlineKeyboardButton("📋 Открыть очередь", callback_data="queue_0")]]
+            try:
+                await self.sender.call(
+                    context.bot.send_message, priority=PRIORITY_HIGH,
+                    chat_id=ADMIN_CHAT_ID,
+                    text=f"🔄 Новых платежей на проверку: {sent}",
+                    reply_markup=InlineKeyboardMarkup(keyboard)
+                )
+            except Exception as e:
+                logger.error(f"Ошибка отправки уведомления админу: {e}")
+
+    async def render_review_page(self, page, selected):
+        """Текст, клавиатура и id платежей страницы очереди"""
+        rows = await self.db.fetchall('''
+            SELECT id, user_id, first_name, username, amount, duplicate_of, created_date
+            FROM pending_payments
+            WHERE status = 'pending' AND screenshot_sent = 1
+            ORDER BY id LIMIT ? OFFSET ?
+        ''', (REVIEW_PAGE_SIZE + 1, page * REVIEW_PAGE_SIZE))
+        has_next = len(rows) > REVIEW_PAGE_SIZE
+        rows = rows[:REVIEW_PAGE_SIZE]
+
+        keyboard = []
+        if rows:
+            lines = [f"📋 Платежи на проверке, страница {page + 1}", ""]
+            for payment_id, user_id, first_name, username, amount, duplicate_of, created_date in rows:
+                mark = '☑' if payment_id in selected else '☐'
+                caption = self.review_caption(payment_id, user_id, first_name, username, amount, duplicate_of)
+                lines.append(f"{mark} {caption} · {created_date}")
+                keyboard.append([
+                    InlineKeyboardButton(f"{mark} #{payment_id} {first_name or ''}",
+                                         callback_data=f"qsel_{page}_{payment_id}"),
+                    InlineKeyboardButton("🖼", callback_data=f"qshow_{payment_id}")
+                ])
+        else:
+            lines = ["📋 Очередь пуста"]
+
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"queue_{page - 1}"))
+        if has_next:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"queue_{page + 1}"))
+        if nav:
+            keyboard.append(nav)
+        if rows:
+            keyboard.append([InlineKeyboardButton(
+                "✅ Подтвердить всю страницу", callback_data=f"qall_{page}"
+            )])
+            keyboard.append([InlineKeyboardButton("❌ Отклонить выбранные", callback_data=f"qrej_{page}")])
+
+        return '\n'.join(lines), InlineKeyboardMarkup(keyboard), [row[0] for row in rows]
+
+    @staticmethod
+    def remember_review_page(chat_data, message_id, payment_ids):
+        """Запоминает платежи, показанные в сообщении очереди
+
+        "Подтвердить всю страницу" подтверждает только их: платеж, скриншот
+        которого пришел после отрисовки страницы, админ еще не видел.
         """
-
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Подтвердить платеж", callback_data=f"confirm_{payment_id}"),
-                InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_{payment_id}")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
+        pages = chat_data.setdefault('review_pages', {})
+        pages.pop(message_id, None)
+        pages[message_id] = payment_ids
+        while len(pages) > REVIEW_PAGES_KEPT:
+            pages.pop(next(iter(pages)))
+
+    async def review_queue(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /queue: постраничная очередь платежей для админа"""
+        if not self.is_admin_chat(update.effective_chat.id):
+            return
+        text, reply_markup, payment_ids = await self.render_review_page(
+            0, context.chat_data.get('review_selected', set())
+        )
+        message = await self.sender.call(
+            update.message.reply_text, text,
+            bucket=update.effective_chat.id, priority=PRIORITY_HIGH, reply_markup=reply_markup
+        )
+        self.remember_review_page(context.chat_data, message.message_id, payment_ids)
+
+    async def export_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /export: пользователи и заявки на оплату в CSV одним zip-файлом"""
+        if not self.is_admin_chat(update.effective_chat.id):
+            return
+        fd, path = tempfile.mkstemp(suffix='.zip')
+        os.close(fd)
         try:
-            await bot.send_photo(
-                chat_id=ADMIN_CHAT_ID,
-                photo=screenshot_file_id,
-                caption=admin_text,
-                parse_mode='Markdown',
-                reply_markup=reply_markup
-            )
+            await self.backup.export(path)
+            with open(path, 'rb') as f:
+                await self.sender.call(
+                    update.message.reply_document, document=f,
+                    filename=f"mindwomen-{datetime.now().strftime('%Y%m%d-%H%M')}.zip",
+                    bucket=update.effective_chat.id, priority=PRIORITY_HIGH
+                )
         except Exception as e:
-            logger.error(f"Ошибка отправки уведомления админу: {e}")
+            logger.error(f"❌ Ошибка выгрузки: {e}")
+            await self.sender.call(
+                update.message.reply_text, "❌ Не удалось подготовить выгрузку",
+                bucket=update.effective_chat.id, priority=PRIORITY_HIGH
+            )
+        finally:
+            os.remove(path)
 
-    async def confirm_payment(self, update: Update, context: ContextTypes.DEFAULT_TYPE, payment_id):
-        """Подтверждает платеж и добавляет в канал"""
+    async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /stats: воронка и выручка за день, неделю и месяц"""
+        if not self.is_admin_chat(update.effective_chat.id):
+            return
+        periods = [('Сегодня', 1), ('7 дней', 7), ('30 дней', 30)]
+        lines = ["📊 Статистика"]
+        for title, days in periods:
+            totals = await self.stats.totals(days)
+            lines.append(f"\n{title}")
+            for metric, label in DailyStats.LABELS.items():
+                lines.append(f"{label}: {totals[metric]}")
+            if totals['starts']:
+                lines.append(f"Конверсия в оплату: {totals['confirmations'] / totals['starts']:.1%}")
+        await self.sender.call(
+            update.message.reply_text, "\n".join(lines),
+            bucket=update.effective_chat.id, priority=PRIORITY_HIGH
+        )
+
+    async def handle_review_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Кнопки очереди платежей: листание, выбор, массовые действия"""
         query = update.callback_query
-        await query.answer()
+        if not self.is_admin_chat(query.message.chat_id):
+            return
 
-        # Получаем информацию о платеже
-        self.cursor.execute('''
-            SELECT user_id FROM pending_payments WHERE id = ?
-        ''', (payment_id,))
-        
-        result = self.cursor.fetchone()
-        if not result:
-            await query.message.reply_text("❌ Платеж не найден")
+        action, *args = query.data.split('_')
+        selected = context.chat_data.setdefault('review_selected', set())
+
+        if action == 'qshow':
+            # Отдельный скриншот с кнопками подтверждения и отклонения
+            payment_id = int(args[0])
+            row = await self.db.fetchone('''
+                SELECT id, user_id, first_name, username, amount, duplicate_of, screenshot_file_id
+                FROM pending_payments WHERE id = ?
+            ''', (payment_id,))
+            if row and row[6]:
+                keyboard = [[
+                    InlineKeyboardButton("✅ Подтвердить платеж", callback_data=f"confirm_{payment_id}"),
+                    InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_{payment_id}")
+                ]]
+                await self.sender.call(
+                    context.bot.send_photo, priority=PRIORITY_HIGH,
+                    chat_id=query.message.chat_id, photo=row[6],
+                    caption=self.review_caption(*row[:6]),
+                    reply_markup=InlineKeyboardMarkup(keyboard)
+                )
             return
 
-        user_id = result[0]
+        page = int(args[0])
+        if action == 'qsel':
+            payment_id = int(args[1])
+            selected.symmetric_difference_update({payment_id})
+        elif action == 'qall':
+            # Страница не запомнена (например, после перезапуска): только перерисовываем
+            shown = context.chat_data.get('review_pages', {}).get(query.message.message_id, [])
+            confirmed = await self.confirm_payments(shown)
+            selected.difference_update(confirmed)
+        elif action == 'qrej':
+            await self.reject_payments(list(selected))
+            selected.clear()
+
+        text, reply_markup, payment_ids = await self.render_review_page(page, selected)
+        self.remember_review_page(context.chat_data, query.message.message_id, payment_ids)
+        try:
+            await self.sender.call(
+                query.edit_message_text, text,
+                bucket=query.message.chat_id, priority=PRIORITY_HIGH, reply_markup=reply_markup
+            )
+        except BadRequest as e:
+            # Страница не изменилась
+            if 'not modified' not in str(e).lower():
+                raise
 
-        # Активируем подписку (1 месяц)
-        subscription_end = datetime.now() + timedelta(days=30)
-        await self.save_subscription(user_id, subscription_end, context.bot)
+    async def confirm_payments(self, payment_ids, message=None):
+        """Подтверждает платежи одной транзакцией
 
-        # Добавляем в канал (исправляем CHANNEL_ID)
+        В той же транзакции в outbox записываются открытие доступа,
+        уведомление пользователя, обновление профиля и, если передано
+        сообщение админа, изменение его подписи. Доставляет их фоновый
+        цикл, обработчик ждет только коммита. Возвращает id подтвержденных.
+        """
+        if not payment_ids:
+            return []
+        placeholders = ','.join('?' * len(payment_ids))
+
+        def write(conn):
+            rows = conn.execute(f'''
+                SELECT id, user_id, first_name, username, amount FROM pending_payments
+                WHERE id IN ({placeholders}) AND status = 'pending'
+            ''', payment_ids).fetchall()
+            confirmed = []
+            for payment_id, user_id, first_name, username, _ in rows:
+                conn.execute(
+                    "UPDATE pending_payments SET status = 'confirmed' WHERE id = ?", (payment_id,)
+                )
+                # Продление до окончания добавляет месяц к текущему сроку
+                row = conn.execute(
+                    'SELECT subscription_end FROM users WHERE user_id = ?', (user_id,)
+                ).fetchone()
+                current_end = db_epoch(row[0]) if row else None
+                subscription_end = max(datetime.now(), datetime.fromtimestamp(current_end or 0)) + timedelta(days=30)
+                self.save_subscription(conn, user_id, subscription_end, username, first_name)
+                confirmed.append((payment_id, user_id, subscription_end))
+                key = f'confirm:{payment_id}'
+                Outbox.add(conn, f'{key}:access', 'unrestrict', user_id=user_id)
+                Outbox.add(conn, f'{key}:notify', 'message', chat_id=user_id, priority=PRIORITY_HIGH,
+                           text=self.texts.render('payment_confirmed', end=subscription_end),
+                           parse_mode='MarkdownV2')
+                Outbox.add(conn, f'{key}:profile', 'profile', user_id=user_id)
+                if message is not None:
+                    Outbox.add(conn, f'{key}:caption', 'caption', chat_id=message.chat_id,
+                               message_id=message.message_id,
+                               caption=self.texts.render('caption_confirmed'), parse_mode='MarkdownV2')
+            DailyStats.add(conn, confirmations=len(rows),
+                           revenue=sum(int(amount or 0) for *_, amount in rows))
+            return confirmed
+
+        confirmed = await self.db.write(write, 'confirm_payments')
+        for _, user_id, subscription_end in confirmed:
+            self.remember_subscription(user_id, subscription_end)
+        self.outbox.wake()
+        logger.info(f"✅ Подтверждено платежей: {len(confirmed)}")
+        return [payment_id for payment_id, *_ in confirmed]
+
+    async def reject_payments(self, payment_ids, message=None):
+        """Отклоняет платежи одной транзакцией, уведомления пишутся в outbox"""
+        if not payment_ids:
+            return []
+        placeholders = ','.join('?' * len(payment_ids))
+
+        def write(conn):
+            rows = conn.execute(f'''
+                SELECT id, user_id FROM pending_payments
+                WHERE id IN ({placeholders}) AND status = 'pending'
+            ''', payment_ids).fetchall()
+            for payment_id, user_id in rows:
+                conn.execute(
+                    "UPDATE pending_payments SET status = 'rejected' WHERE id = ?", (payment_id,)
+                )
+                key = f'reject:{payment_id}'
+                Outbox.add(conn, f'{key}:notify', 'message', chat_id=user_id, priority=PRIORITY_HIGH,
+                           text=self.texts.render('payment_rejected'), parse_mode='MarkdownV2')
+                if message is not None:
+                    Outbox.add(conn, f'{key}:caption', 'caption', chat_id=message.chat_id,
+                               message_id=message.message_id,
+                               caption=self.texts.render('caption_rejected'), parse_mode='MarkdownV2')
+            DailyStats.add(conn, rejections=len(rows))
+            return [payment_id for payment_id, _ in rows]
+
+        rejected = await self.db.write(write, 'reject_payments')
+        self.outbox.wake()
+        logger.info(f"Отклонено платежей: {len(rejected)}")
+        return rejected
+
+    def setup_outbox(self, bot):
+        """Регистрирует доставщиков действий outbox"""
+        self.outbox.register('unrestrict', lambda user_id: self.unrestrict_user(bot, user_id))
+        self.outbox.register('ban', lambda user_id: self.ban_user(bot, user_id))
+        self.outbox.register('unban', lambda user_id: self.unban_user(bot, user_id))
+        self.outbox.register('profile', lambda user_id: self.update_profile(bot, user_id))
+        self.outbox.register('message', lambda **payload: self.send_outbox_message(bot, **payload))
+        self.outbox.register('caption', lambda chat_id, message_id, caption, parse_mode=None: self.sender.call(
+            bot.edit_message_caption, chat_id=chat_id, message_id=message_id, caption=caption,
+            parse_mode=parse_mode, priority=PRIORITY_HIGH
+        ))
+
+    async def send_outbox_message(self, bot, chat_id, text, priority=PRIORITY_NORMAL, buttons=None,
+                                  keyboard=None, parse_mode='Markdown', unless_active=False):
+        """Сообщение из outbox
+
+        parse_mode по умолчанию - как у действий, записанных до перехода на
+        шаблоны. С unless_active сообщение не отправляется, если к моменту
+        доставки подписка получателя снова активна (продлил после окончания).
+        """
+        if unless_active and await self.subscription_active(chat_id):
+            logger.info(f"Пропущено уведомление об окончании для {chat_id}: подписка продлена")
+            return
+        await self.sender.call(
+            bot.send_message, chat_id=chat_id, text=text, parse_mode=parse_mode, priority=priority,
+            reply_markup=self.texts.keyboard(keyboard) if keyboard else InlineKeyboardMarkup(
+                [[InlineKeyboardButton(label, callback_data=data)] for label, data in buttons]
+            ) if buttons else None
+        )
+
+    async def subscription_active(self, user_id):
+        """Активна ли подписка по БД, без кэша: для действий, доставляемых с задержкой"""
+        row = await self.db.fetchone(
+            'SELECT subscription_end FROM users WHERE user_id = ? AND removed = 0', (user_id,)
+        )
+        end_ts = db_epoch(row[0]) if row else None
+        return end_ts is not None and end_ts > time.time()
+
+    def roster_skipped(self, action, user_id, status):
+        logger.info(f"Пропущен вызов {action} для {user_id}: статус в канале {status}")
+        self.metrics.inc('bot_roster_skipped_total', action=action)
+
+    async def unrestrict_user(self, bot, user_id):
+        """Открывает пользователю доступ в канал
+
+        По составу канала: участнику без ограничений и вышедшему ничего делать
+        не нужно (вступит по ссылке), заблокированного разблокируем.
+        """
+        channel_id = self.channel_id
+        status = await self.roster.get(user_id)
+        if status == 'kicked':
+            await self.unban_user(bot, user_id)
+            return
+        if status in ('creator', 'administrator', 'member', 'left'):
+            self.roster_skipped('restrict', user_id, status)
+            return
         try:
-            # Убедимся, что CHANNEL_ID правильный (должен начинаться с -100 для супергрупп)
-            channel_id = self.get_correct_channel_id(CHANNEL_ID)
-            
-            await context.bot.restrict_chat_member(
+            await self.sender.call(
+                bot.restrict_chat_member,
+                priority=PRIORITY_HIGH,
+                bucket=NO_CHAT_LIMIT,
                 chat_id=channel_id,
                 user_id=user_id,
                 permissions={
@@ -326,42 +2983,146 @@ class SubscriptionBot:
                     'can_pin_messages': False
                 }
             )
-            logger.info(f"✅ Пользователь {user_id} добавлен в канал {channel_id}")
-            
         except BadRequest as e:
             if "chat not found" in str(e).lower():
                 logger.error(f"❌ Канал не найден: {CHANNEL_ID}. Проверьте CHANNEL_ID в настройках.")
-                await query.message.reply_text("❌ Ошибка: канал не найден. Проверьте настройки бота.")
-            else:
-                logger.error(f"❌ Ошибка добавления в канал: {e}")
-        except Exception as e:
-            logger.error(f"❌ Неизвестная ошибка при добавлении в канал: {e}")
+                await self.sender.call(
+                    bot.send_message, priority=PRIORITY_HIGH,
+                    chat_id=ADMIN_CHAT_ID, text="❌ Ошибка: канал не найден. Проверьте настройки бота."
+                )
+            raise
+        logger.info(f"✅ Пользователь {user_id} добавлен в канал {channel_id}")
 
-        # Уведомляем пользователя
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"""
-🎉 *Платеж подтвержден!*
+    async def ban_user(self, bot, user_id):
+        """Удаляет пользователя из канала, если он в нем есть
 
-Ваша подписка на MindWomen активирована до {subscription_end.strftime('%d.%m.%Y')}
+        Бан доставляется с низким приоритетом, и за время ожидания в очереди
+        пользователь может продлить подписку, поэтому она проверяется заново.
+        """
+        if await self.subscription_active(user_id):
+            logger.info(f"Пропущен бан {user_id}: подписка активна")
+            self.metrics.inc('bot_stale_bans_skipped_total')
+            return
+        status = await self.roster.get(user_id)
+        if status in ('left', 'kicked'):
+            self.roster_skipped('ban', user_id, status)
+            return
+        await self.sender.call(
+            bot.ban_chat_member, priority=PRIORITY_BULK, bucket=NO_CHAT_LIMIT,
+            chat_id=self.channel_id, user_id=user_id
+        )
+        await self.roster.set(user_id, 'kicked')
+        logger.info(f"Удален пользователь {user_id} - закончилась подписка")
+
+    async def unban_user(self, bot, user_id):
+        """Снимает блокировку, чтобы пользователь мог вступить по ссылке"""
+        await self.sender.call(
+            bot.unban_chat_member, priority=PRIORITY_HIGH, bucket=NO_CHAT_LIMIT,
+            chat_id=self.channel_id, user_id=user_id, only_if_banned=True
+        )
+        await self.roster.set(user_id, 'left')
+        logger.info(f"✅ Пользователь {user_id} разблокирован в канале")
+
+    def is_channel(self, chat):
+        if str(self.channel_id).startswith('@'):
+            return bool(chat.username) and f'@{chat.username}'.lower() == self.channel_id.lower()
+        # get_correct_channel_id возвращает строку, если дописывал префикс -100
+        return str(chat.id) == str(self.channel_id)
+
+    async def track_channel_member(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обновляет состав канала по событию chat_member
+
+        Вступивший пользователь с закончившейся подпиской сразу удаляется.
+        """
+        event = update.chat_member
+        if not self.is_channel(event.chat):
+            return
+        member = event.new_chat_member
+        status = str(member.status)
+        if status == 'restricted' and not member.is_member:
+            status = 'left'
+        user_id = member.user.id
+        await self.roster.set(user_id, status)
+
+        if status in ('member', 'restricted'):
+            row = await self.db.fetchone('SELECT subscription_end FROM users WHERE user_id = ?', (user_id,))
+            end_ts = db_epoch(row[0]) if row else None
+            if row and (end_ts or 0) <= time.time():
+                key = f'join:{user_id}:{int(event.date.timestamp())}:ban'
+                await self.db.write(lambda conn: Outbox.add(conn, key, 'ban', user_id=user_id), 'roster_ban')
+                self.outbox.wake()
+
+    async def reconcile_roster(self, context: ContextTypes.DEFAULT_TYPE):
+        """Сверяет состав канала с подписками и ставит в outbox только нужные вызовы
+
+        Участник с закончившейся подпиской удаляется, заблокированный с
+        активной подпиской разблокируется. Пользователи, которых нет в
+        users (админы, добавленные вручную), не трогаются.
+        """
+        now_ts = time.time()
+        await self.roster.load()
+
+        def write(conn):
+            bans = unbans = 0
+            for user_id, status, end in conn.execute('''
+                SELECT m.user_id, m.status, u.subscription_end
+                FROM channel_members m JOIN users u ON u.user_id = m.user_id
+                WHERE m.status IN ('member', 'restricted', 'kicked')
+            '''):
+                end_ts = db_epoch(end)
+                active = (end_ts or 0) > now_ts
+                if status == 'kicked' and active:
+                    Outbox.add(conn, f'grant:{user_id}:{end_ts}:unban', 'unban', user_id=user_id)
+                    unbans += 1
+                elif status != 'kicked' and not active:
+                    Outbox.add(conn, f'reconcile:{user_id}:{int(now_ts)}:ban', 'ban', user_id=user_id)
+                    bans += 1
+            return bans, unbans
+
+        bans, unbans = await self.db.write(write, 'reconcile_roster')
+        self.outbox.wake()
+        if bans or unbans:
+            logger.info(f"Сверка состава канала: удалить {bans}, разблокировать {unbans}")
+
+    async def update_profile(self, bot, user_id):
+        """Обновляет имя и username пользователя из Telegram"""
+        user_chat = await self.sender.call(bot.get_chat, user_id, priority=PRIORITY_BULK)
+        await self.db.execute('''
+            UPDATE users SET username = ?, first_name = ?, last_name = ? WHERE user_id = ?
+        ''', (user_chat.username, user_chat.first_name, user_chat.last_name, user_id))
+
+    async def edit_review_caption(self, query, caption):
+        try:
+            await self.sender.call(
+                query.edit_message_caption, caption=caption, parse_mode='MarkdownV2',
+                bucket=query.message.chat_id, priority=PRIORITY_HIGH
+            )
+        except BadRequest as e:
+            # Подпись уже такая
+            if 'not modified' not in str(e).lower():
+                logger.error(f"Ошибка изменения подписи: {e}")
 
-*Ссылка на закрытый канал:* https://t.me/+Yx9m02RdviBmNjAy
+    async def confirm_payment(self, update: Update, context: ContextTypes.DEFAULT_TYPE, payment_id):
+        """Подтверждает платеж и добавляет в канал
 
-Добро пожаловать в Клуб! 💖
-                """,
-                parse_mode='Markdown'
-            )
-        except Exception as e:
-            logger.error(f"Ошибка уведомления пользователя: {e}")
+        Обработчик только фиксирует решение в БД, вызовы Telegram выполняет
+        outbox. Повторное нажатие ничего не делает повторно.
+        """
+        query = update.callback_query
 
-        # Обновляем статус платежа
-        self.cursor.execute('''
-            UPDATE pending_payments SET status = 'confirmed' WHERE id = ?
-        ''', (payment_id,))
-        self.conn.commit()
+        if await self.confirm_payments([int(payment_id)], message=query.message):
+            return
 
-        await query.edit_message_caption(caption="✅ *Платеж подтвержден*\n\nПользователь добавлен в канал")
+        result = await self.db.fetchone(
+            'SELECT status FROM pending_payments WHERE id = ?', (payment_id,)
+        )
+        if not result:
+            await self.sender.call(
+                query.message.reply_text, "❌ Платеж не найден",
+                bucket=query.message.chat_id, priority=PRIORITY_HIGH
+            )
+        elif result[0] == 'rejected':
+            await self.edit_review_caption(query, self.texts.render('caption_already_rejected'))
 
     def get_correct_channel_id(self, channel_id):
         """Корректирует ID канала для Telegram API"""
@@ -381,75 +3142,54 @@ class SubscriptionBot:
             # Если это не число, возвращаем как есть (скорее всего username)
             return channel_id
 
-    async def save_subscription(self, user_id, subscription_end, bot):
-        """Сохраняет информацию о подписке в БД (исправленная версия)"""
-        try:
-            # Получаем информацию о пользователе через await
-            user_chat = await bot.get_chat(user_id)
-            
-            self.cursor.execute('''
-                INSERT OR REPLACE INTO users (user_id, username, first_name, last_name, subscription_end)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                user_id, 
-                user_chat.username, 
-                user_chat.first_name, 
-                user_chat.last_name, 
-                subscription_end
-            ))
-            self.conn.commit()
-            logger.info(f"✅ Подписка сохранена для пользователя {user_id}")
-            
-        except Exception as e:
-            logger.error(f"❌ Ошибка сохранения подписки: {e}")
-            # Если не удалось получить данные пользователя, сохраняем хотя бы ID
-            self.cursor.execute('''
-                INSERT OR REPLACE INTO users (user_id, subscription_end)
-                VALUES (?, ?)
-            ''', (user_id, subscription_end))
-            self.conn.commit()
+    @staticmethod
+    def save_subscription(conn, user_id, subscription_end, username=None, first_name=None):
+        """Сохраняет подписку в БД (вызывается внутри транзакции записи)"""
+        conn.execute('''
+            INSERT INTO users (user_id, username, first_name, subscription_end)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username = COALESCE(excluded.username, username),
+                first_name = COALESCE(excluded.first_name, first_name),
+                subscription_end = excluded.subscription_end,
+                removed = 0
+        ''', (user_id, username, first_name, math.ceil(subscription_end.timestamp())))
+
+    def remember_subscription(self, user_id, subscription_end):
+        """Обновляет очередь окончаний и кэш после сохранения подписки"""
+        end_ts = math.ceil(subscription_end.timestamp())
+        self.expiry.schedule(user_id, end_ts)
+        self.reminders.schedule(user_id, end_ts)
+        self.subscriptions.set(user_id, end_ts)
+        logger.info(f"✅ Подписка сохранена для пользователя {user_id}")
 
     async def reject_payment(self, update: Update, context: ContextTypes.DEFAULT_TYPE, payment_id):
         """Отклоняет платеж"""
         query = update.callback_query
-        await query.answer()
 
-        self.cursor.execute('''
-            SELECT user_id FROM pending_payments WHERE id = ?
-        ''', (payment_id,))
-        
-        result = self.cursor.fetchone()
-        if result:
-            user_id = result[0]
-            
-            # Уведомляем пользователя
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text="❌ *Платеж отклонен*\n\nПожалуйста, свяжитесь с администратором.",
-                    parse_mode='Markdown'
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
-
-        self.cursor.execute('''
-            UPDATE pending_payments SET status = 'rejected' WHERE id = ?
-        ''', (payment_id,))
-        self.conn.commit()
+        if await self.reject_payments([int(payment_id)], message=query.message):
+            return
 
-        await query.edit_message_caption(caption="❌ *Платеж отклонен*")
+        result = await self.db.fetchone(
+            'SELECT status FROM pending_payments WHERE id = ?', (payment_id,)
+        )
+        if result and result[0] == 'confirmed':
+            await self.edit_review_caption(query, self.texts.render('caption_already_confirmed'))
 
-    def get_user_subscription(self, user_id):
+    async def get_user_subscription(self, user_id):
         """Получает информацию о подписке пользователя"""
+        end_ts = self.subscriptions.get(user_id)
+        if end_ts is not None:
+            return datetime.fromtimestamp(end_ts) if end_ts else None
+
         try:
-            self.cursor.execute(
+            result = await self.db.fetchone(
                 'SELECT subscription_end FROM users WHERE user_id = ?',
                 (user_id,)
             )
-            result = self.cursor.fetchone()
-            if result and result[0]:
-                return datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S')
-            return None
+            end_ts = db_epoch(result[0]) if result else None
+            self.subscriptions.set(user_id, end_ts or 0)
+            return datetime.fromtimestamp(end_ts) if end_ts else None
         except Exception as e:
             logger.error(f"Ошибка получения подписки: {e}")
             return None
@@ -457,77 +3197,279 @@ class SubscriptionBot:
     async def my_subscription(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показывает информацию о подписке пользователя"""
         user = update.effective_user
-        subscription_end = self.get_user_subscription(user.id)
+        lang = self.texts.language(user)
+        subscription_end = await self.get_user_subscription(user.id)
 
         if subscription_end and subscription_end > datetime.now():
-            text = f"""
-✅ *Ваша подписка активна*
-
-*Действует до:* {subscription_end.strftime('%d.%m.%Y')}
-*Осталось:* {(subscription_end - datetime.now()).days} дней
-
-*Ссылка на канал:* https://t.me/+Yx9m02RdviBmNjAy
-            """
+            text = self.texts.render('subscription_active', lang, end=subscription_end,
+                                     days=(subscription_end - datetime.now()).days)
         else:
-            text = """
-❌ *У вас нет активной подписки*
+            text = self.texts.render('subscription_none', lang)
 
-Для доступа к закрытому сообществу MindWomen приобретите подписку.
+        await self.sender.call(
+            update.message.reply_text, text,
+            bucket=update.effective_chat.id, parse_mode='MarkdownV2'
+        )
 
-Нажмите /start для оплаты.
-            """
+    async def check_subscriptions(self, context: ContextTypes.DEFAULT_TYPE):
+        """Удаляет пользователей, у которых закончилась подписка
 
-        await update.message.reply_text(text, parse_mode='Markdown')
+        Вся пачка помечается удаленной одной транзакцией, бан и уведомление
+        пишутся в outbox той же транзакцией.
+        """
+        now_ts = time.time()
+        if WORKER_INDEX is None:
+            user_ids = self.expiry.pop_due(now_ts)
+        else:
+            # Подписки выдают все процессы, поэтому лидер берет окончания из БД
+            user_ids = [row[0] for row in await self.db.fetchall('''
+                SELECT user_id FROM users
+                WHERE removed = 0 AND subscription_end <= ?
+                LIMIT ?
+            ''', (now_ts, EXPIRY_BATCH))]
+        if not user_ids:
+            return
 
-    async def check_subscriptions(self, context: ContextTypes.DEFAULT_TYPE):
-        """Проверяет подписки и удаляет тех, у кого закончилась"""
-        now = datetime.now()
+        def write(conn):
+            expired = []
+            for user_id in user_ids:
+                # Помечаем подписку обработанной, чтобы удалить пользователя ровно один раз
+                row = conn.execute('''
+                    SELECT subscription_end FROM users WHERE user_id = ? AND removed = 0
+                ''', (user_id,)).fetchone()
+                end_ts = db_epoch(row[0]) if row else None
+                if end_ts is None or end_ts > now_ts:
+                    continue
+                conn.execute('UPDATE users SET removed = 1 WHERE user_id = ?', (user_id,))
+                key = f'expire:{user_id}:{end_ts}'
+                Outbox.add(conn, f'{key}:ban', 'ban', user_id=user_id)
+                Outbox.add(conn, f'{key}:notify', 'message', chat_id=user_id, priority=PRIORITY_BULK,
+                           text=self.texts.render('subscription_expired'), parse_mode='MarkdownV2',
+                           unless_active=True)
+                expired.append(user_id)
+            DailyStats.add(conn, churn=len(expired))
+            return expired
 
         try:
-            self.cursor.execute(
-                'SELECT user_id FROM users WHERE subscription_end < ?',
-                (now.strftime('%Y-%m-%d %H:%M:%S'),)
+            expired = await self.db.write(write, 'expire_users')
+        except Exception:
+            if WORKER_INDEX is None:
+                # Пачка не записана: повторим на следующей проверке
+                self.expiry.requeue(user_ids, now_ts)
+            raise
+        for user_id in expired:
+            self.reminders.cancel(user_id)
+            self.subscriptions.set(user_id, 0)
+        self.outbox.wake()
+        if expired:
+            logger.info(f"Подписка закончилась у пользователей: {len(expired)}")
+
+    async def send_reminders(self, context: ContextTypes.DEFAULT_TYPE):
+        """Напоминает о скором окончании подписки
+
+        Сработавшие за тик напоминания пишутся в outbox одной транзакцией
+        с низким приоритетом, SendEngine растягивает их отправку по лимиту.
+        Ключ outbox включает окончание подписки, поэтому повтор после
+        перезапуска или смены лидера не дублирует сообщение.
+        """
+        now_ts = time.time()
+        if WORKER_INDEX is None:
+            due = self.reminders.advance(now_ts)
+        else:
+            # Подписки выдают все процессы: лидер ищет в индексе БД окончания,
+            # для которых время напоминания попало в интервал с прошлого тика.
+            # Конец интервала хранится в leases, поэтому новый лидер после
+            # смены или перезапуска досылает пропущенное за перерыв - как и в
+            # одном процессе, одно напоминание, ближайшее к окончанию
+            row = await self.db.fetchone("SELECT expires FROM leases WHERE name = 'reminders'")
+            since = row[0] if row else now_ts - REMINDER_TICK
+            latest = {}
+            for days in sorted(REMINDER_OFFSETS, reverse=True):
+                rows = await self.db.fetchall('''
+                    SELECT user_id, subscription_end FROM users
+                    WHERE removed = 0 AND subscription_end > ? AND subscription_end <= ?
+                        AND subscription_end > ?
+                ''', (since + days * 86400, now_ts + days * 86400, now_ts))
+                latest.update((user_id, (end_ts, days)) for user_id, end_ts in rows)
+            due = [(user_id, end_ts, days) for user_id, (end_ts, days) in latest.items()]
+
+        def write(conn):
+            if WORKER_INDEX is not None:
+                conn.execute('''
+                    INSERT INTO leases (name, expires) VALUES ('reminders', ?)
+                    ON CONFLICT(name) DO UPDATE SET expires = excluded.expires
+                ''', (now_ts,))
+            sent = 0
+            for user_id, end_ts, days in due:
+                row = conn.execute('''
+                    SELECT subscription_end FROM users WHERE user_id = ? AND removed = 0
+                ''', (user_id,)).fetchone()
+                if not row or db_epoch(row[0]) != end_ts:
+                    continue
+                Outbox.add(conn, f'remind:{user_id}:{end_ts}:{days}', 'message',
+                           chat_id=user_id, priority=PRIORITY_BULK, keyboard='renew',
+                           text=self.texts.render('renewal_reminder', end=datetime.fromtimestamp(end_ts)),
+                           parse_mode='MarkdownV2')
+                sent += 1
+            return sent
+
+        if not due and WORKER_INDEX is None:
+            return
+        sent = await self.db.write(write, 'send_reminders')
+        self.outbox.wake()
+        if sent:
+            logger.info(f"Напоминаний о продлении поставлено в очередь: {sent}")
+
+    async def backup_database(self, context: ContextTypes.DEFAULT_TYPE):
+        """Сохраняет сжатый снимок БД и удаляет старые"""
+        path = await self.backup.snapshot()
+        logger.info(f"💾 Снимок БД сохранен: {path} ({os.path.getsize(path)} байт)")
+
+    async def compact_payments(self, context: ContextTypes.DEFAULT_TYPE):
+        """Уборка таблиц платежей и outbox
+
+        Заявки без скриншота старше PAYMENT_PENDING_DAYS получают статус
+        expired, закрытые заявки старше PAYMENT_ARCHIVE_DAYS переносятся в
+        архив, доставленные действия outbox удаляются. Работа идет пачками
+        по COMPACTION_BATCH строк, каждая пачка - отдельная транзакция,
+        чтобы не задерживать запись обработчиков.
+        """
+        stale = f'-{PAYMENT_PENDING_DAYS} days'
+        old = f'-{PAYMENT_ARCHIVE_DAYS} days'
+
+        def expire(conn):
+            return conn.execute('''
+                UPDATE pending_payments SET status = 'expired'
+                WHERE id IN (
+                    SELECT id FROM pending_payments
+                    WHERE status = 'pending' AND created_date < datetime('now', ?)
+                        AND screenshot_sent = 0
+                    LIMIT ?
+                )
+            ''', (stale, COMPACTION_BATCH)).rowcount
+
+        def archive(conn):
+            ids = [row[0] for row in conn.execute('''
+                SELECT id FROM pending_payments
+                WHERE status IN ('confirmed', 'rejected', 'expired') AND created_date < datetime('now', ?)
+                LIMIT ?
+            ''', (old, COMPACTION_BATCH))]
+            if ids:
+                placeholders = ','.join('?' * len(ids))
+                conn.execute(f'''
+                    INSERT OR REPLACE INTO pending_payments_archive
+                        (id, user_id, amount, screenshot_sent, created_date, status,
+                         screenshot_file_id, first_name, username, duplicate_of)
+                    SELECT id, user_id, amount, screenshot_sent, created_date, status,
+                           screenshot_file_id, first_name, username, duplicate_of
+                    FROM pending_payments WHERE id IN ({placeholders})
+                ''', ids)
+                conn.execute(f'DELETE FROM pending_payments WHERE id IN ({placeholders})', ids)
+            return len(ids)
+
+        def purge_outbox(conn):
+            return conn.execute('''
+                DELETE FROM outbox WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE status = 'done' AND created_date < datetime('now', ?)
+                    LIMIT ?
+                )
+            ''', (old, COMPACTION_BATCH)).rowcount
+
+        totals = {}
+        for name, step in (('expired', expire), ('archived', archive), ('outbox', purge_outbox)):
+            total = 0
+            while True:
+                count = await self.db.write(step, f'compact_{name}')
+                total += count
+                if count < COMPACTION_BATCH:
+                    break
+            totals[name] = total
+
+        if any(totals.values()):
+            logger.info(
+                f"Уборка платежей: просрочено {totals['expired']}, в архиве {totals['archived']}, "
+                f"удалено из outbox {totals['outbox']}"
             )
-            expired_users = self.cursor.fetchall()
-
-            for user_id, in expired_users:
-                try:
-                    # Удаляем из канала
-                    channel_id = self.get_correct_channel_id(CHANNEL_ID)
-                    await context.bot.ban_chat_member(chat_id=channel_id, user_id=user_id)
-                    
-                    # Уведомляем пользователя
-                    try:
-                        await context.bot.send_message(
-                            chat_id=user_id,
-                            text="❌ Ваша подписка закончилась. Для продления нажмите /start",
-                            parse_mode='Markdown'
-                        )
-                    except:
-                        pass
-
-                    logger.info(f"Удален пользователь {user_id} - закончилась подписка")
-
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении пользователя {user_id}: {e}")
-
-        except Exception as e:
-            logger.error(f"Ошибка проверки подписок: {e}")
 
     def run(self):
         """Запуск бота"""
-        logger.info("Бот запускается...")
-        self.application.run_polling()
+        logger.info(f"Бот запускается в режиме {BOT_MODE}...")
+        if WORKER_INDEX is not None:
+            asyncio.run(self.run_worker())
+        elif BOT_MODE == 'webhook':
+            self.application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES
+            )
+        else:
+            self.application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+    async def run_worker(self):
+        """Воркер за ShardRouter: принимает апдейты своей доли пользователей"""
+        application = self.application
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        async with application:
+            await self.post_init(application)
+            await application.start()
+            server = await asyncio.start_server(
+                self.receive_updates, '127.0.0.1', WORKER_BASE_PORT + WORKER_INDEX
+            )
+            logger.info(f"Воркер {WORKER_INDEX} принимает апдейты на порту {WORKER_BASE_PORT + WORKER_INDEX}")
+
+            await stop.wait()
+            server.close()
+            await server.wait_closed()
+            await application.stop()
+            await self.post_shutdown(application)
+
+    async def receive_updates(self, reader, writer):
+        """Принимает апдейты от роутера и кладет их в очередь Application"""
+        try:
+            while True:
+                request = await read_http_request(reader)
+                if request is None:
+                    break
+                update = Update.de_json(json.loads(request[3]), self.application.bot)
+                # Очередь ограничена: при перегрузке роутер ждет ответа
+                await self.application.update_queue.put(update)
+                writer.write(http_response('200 OK'))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # Остановка сервера: соединение просто закрываем
+            pass
+        finally:
+            writer.close()
 
 if __name__ == "__main__":
+    # python bot.py --migrate-dry-run - показать план миграций, ничего не меняя
+    if '--migrate-dry-run' in sys.argv:
+        plan = SchemaMigrator(DB_PATH).plan()
+        print('\n'.join(plan) if plan else "Схема базы данных актуальна")
+        exit(0)
+
     BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
     if not BOT_TOKEN:
         print("❌ ОШИБКА: TELEGRAM_BOT_TOKEN не найден!")
         exit(1)
 
     try:
-        bot = SubscriptionBot(BOT_TOKEN)
-        bot.run()
+        if BOT_MODE == 'webhook' and WEBHOOK_WORKERS > 1 and WORKER_INDEX is None:
+            ShardRouter(BOT_TOKEN).run()
+        else:
+            bot = SubscriptionBot(BOT_TOKEN)
+            bot.run()
     except Exception as e:
         logger.error(f"Критическая ошибка запуска бота: {e}")
         exit(1)
@@ -0,0 +1,140 @@
+"""Воспроизведение записанных апдейтов на локальном фейковом Bot API
+
+Читает файлы, записанные ботом с RECORD_UPDATES, и подает апдейты в
+настоящий SubscriptionBot с исходными интервалами между ними, ускоренными
+в --speed раз (0 - без пауз, с максимальной скоростью). Бот забирает апдейты
+через getUpdates фейкового API, как при обычном polling, и они проходят очередь
+апдейтов и PerUserUpdateProcessor с тем же параллелизмом, обратным давлением и
+порядком внутри пользователя. В конце печатает задержки по видам апдейтов (от
+запланированного момента поступления до конца обработки), ошибки обработчиков,
+нарушения порядка, время в SQLite и число вызовов Bot API. Так сборки
+сравниваются на реальной форме трафика.
+
+В режиме шардов каждый процесс пишет свой файл <путь>.<номер>: их нужно
+передать все сразу, апдейты сливаются по времени поступления. Чтобы id одного
+пользователя совпадали в файлах разных процессов, бот должен писать с общим
+RECORD_SALT.
+
+База при воспроизведении пустая, поэтому кнопки админа по платежам из
+записи, которых в ней нет, отрабатывают как повторные нажатия.
+
+Пример:
+    RECORD_UPDATES=updates.jsonl python bot.py
+    python replay.py updates.jsonl --speed 10 --latency 30
+    python replay.py updates.jsonl.* --speed 10
+"""
+import argparse
+import asyncio
+import heapq
+import json
+import logging
+import time
+
+from benchmark import (BOT_TOKEN, CHANNEL_ID, FakeBotApi, UpdateTracker, drain_outbox, print_report,
+                       setup_environment, start_polling, stop_polling)
+
+
+def read_file(path):
+    """Пары (время поступления, апдейт) из одного файла записи"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if 'update' in record:
+                yield record['ts'], record['update']
+
+
+def read_recording(paths):
+    """Заголовок записи и пары (время поступления, апдейт) из всех файлов по времени
+
+    Id канала берется из первого заголовка, где он известен. Каждый файл
+    дописывается по порядку поступления, поэтому их достаточно слить.
+    """
+    header = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            header = json.loads(f.readline())['header']
+        if header.get('channel_id'):
+            break
+    return header, heapq.merge(*(read_file(path) for path in paths), key=lambda record: record[0])
+
+
+def update_kind(data):
+    """Вид апдейта для отчета: команда, префикс кнопки, скриншот, chat_member"""
+    message = data.get('message')
+    if message:
+        text = message.get('text') or ''
+        if text.startswith('/'):
+            return text.split('@')[0]
+        return 'screenshot' if message.get('photo') else 'message'
+    query = data.get('callback_query')
+    if query:
+        payload = query.get('data') or ''
+        return payload if payload == 'pay_subscription' else payload.split('_')[0]
+    if data.get('chat_member'):
+        return 'chat_member'
+    return 'other'
+
+
+async def run_replay(args):
+    header, records = read_recording(args.recordings)
+    api = FakeBotApi(latency=args.latency / 1000, rate_429=args.rate_429)
+    await api.start()
+    bot_module = setup_environment(api, args.unthrottled, channel_id=header.get('channel_id') or CHANNEL_ID,
+                                   prefix='mindwomen-replay-')
+
+    bot = bot_module.SubscriptionBot(BOT_TOKEN)
+    application = bot.application
+    tracker = UpdateTracker(api, application)
+    pending = []
+    lag = 0.0
+
+    async with application:
+        await bot.post_init(application)
+        await start_polling(application)
+
+        db_before = {k: list(v) for k, v in bot.db.timings.items()}
+        started = time.perf_counter()
+        first_ts = None
+        for ts, data in records:
+            first_ts = ts if first_ts is None else first_ts
+            due = started + (ts - first_ts) / args.speed if args.speed else time.perf_counter()
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lag = max(lag, time.perf_counter() - due)
+            pending.append(tracker.submit(update_kind(data), data, started=due))
+        await asyncio.gather(*pending)
+        elapsed = time.perf_counter() - started
+        drain = await drain_outbox(bot)
+
+        await stop_polling(application)
+    await bot.post_shutdown(application)
+    await api.stop()
+
+    total = sum(len(v) for v in tracker.latencies.values())
+    print(f"\nАпдейтов: {total}, время: {elapsed + drain:.2f} с "
+          f"(из них доставка outbox после последнего апдейта: {drain:.2f} с), скорость: "
+          f"{f'x{args.speed:g}' if args.speed else 'максимальная'}, "
+          f"{total / (elapsed + drain):.1f} апдейтов/с, макс. отставание от записи: {lag * 1000:.0f} мс\n")
+    steps = sorted(tracker.latencies, key=lambda name: -len(tracker.latencies[name]))
+    print_report(steps, tracker, bot.db.timings, db_before, api)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recordings', nargs='+',
+                        help='файлы JSON Lines, записанные с RECORD_UPDATES (по одному на процесс)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='во сколько раз ускорить запись (0 - без пауз)')
+    parser.add_argument('--latency', type=float, default=20, help='задержка ответа Bot API, мс')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='доля ответов 429 Too Many Requests')
+    parser.add_argument('--unthrottled', action='store_true',
+                        help='снять лимиты SendEngine, чтобы мерить только сам бот')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    asyncio.run(run_replay(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:TEST')
+os.environ.setdefault('CHANNEL_ID', '-1001')
+os.environ.setdefault('ADMIN_CHAT_ID', '1')
+os.environ.setdefault('CARD_NUMBER', '0000 0000 0000 0000')
+os.environ.setdefault('CARD_HOLDER', 'Test')
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'subscriptions.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import ReminderWheel  # noqa: E402
+
+TICK = 60
+
+
+def drive(wheel, start, until, phase):
+    """Вызывает advance() раз в тик со сдвигом phase, как job_queue"""
+    fired = []
+    now = (start // TICK + 1) * TICK + phase
+    while now <= until:
+        fired.extend((now, item) for item in wheel.advance(now))
+        now += TICK
+    return fired
+
+
+def test_reminders_fire_on_first_tick_after_fire_time():
+    rng = random.Random(17)
+    for _ in range(200):
+        start = time.time()
+        wheel = ReminderWheel(offsets=(3, 1), tick=TICK, slots=1440)
+        end_ts = start + 4 * 86400 + rng.uniform(0, 86400)
+        wheel.schedule(42, end_ts, start)
+        fired = drive(wheel, start, end_ts, rng.uniform(0, TICK))
+
+        assert [item for _, item in fired] == [(42, end_ts, 3), (42, end_ts, 1)]
+        for (now, (_, _, days)), offset in zip(fired, (3, 1)):
+            # Срабатывание на первом вызове после границы тика, следующей за fire_ts
+            fire_ts = end_ts - offset * 86400
+            assert fire_ts <= now < fire_ts + 2 * TICK
+
+
+def test_missed_reminder_fires_on_next_tick():
+    start = time.time()
+    wheel = ReminderWheel(offsets=(3, 1), tick=TICK, slots=1440)
+    end_ts = start + 3600
+    wheel.schedule(7, end_ts, start)
+    fired = drive(wheel, start, start + 2 * TICK, 0.5)
+
+    assert [item for _, item in fired] == [(7, end_ts, 1)]
+
+
+def test_renewed_subscription_drops_stale_entries():
+    start = time.time()
+    wheel = ReminderWheel(offsets=(1,), tick=TICK, slots=1440)
+    wheel.schedule(5, start + 86400 + 2 * TICK, start)
+    renewed = start + 31 * 86400
+    wheel.schedule(5, renewed, start)
+
+    assert drive(wheel, start, start + 4 * TICK, 1.0) == []